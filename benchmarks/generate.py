@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+import argparse
+import csv
+import random
+
+
+def fieldnames(columns, numeric):
+    # The first column is the key, then numeric columns (n1, n2, ...) and
+    # text columns (s1, s2, ...), numeric being the share of numeric columns.
+    others = max(columns - 1, 0)
+    n_numeric = round(others * numeric)
+    return (
+        ["key"]
+        + ["n{}".format(i + 1) for i in range(n_numeric)]
+        + ["s{}".format(i + 1) for i in range(others - n_numeric)]
+    )
+
+
+def _text(rng, quoting):
+    value = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(8))
+    if rng.random() < quoting:
+        # values which need to be quoted
+        value = rng.choice(
+            (
+                '{} "{}"'.format(value[:4], value[4:]),
+                "{},{}".format(value[:4], value[4:]),
+                "{}\n{}".format(value[:4], value[4:]),
+            )
+        )
+    return value
+
+
+def rows(rows, columns, *, cardinality, quoting=0.0, numeric=0.5, seed=0):
+    rng = random.Random(seed)
+    names = fieldnames(columns, numeric)
+    for _ in range(rows):
+        row = []
+        for name in names:
+            if name == "key":
+                row.append("k{}".format(rng.randrange(cardinality)))
+            elif name[0] == "n":
+                row.append("{:.3f}".format(rng.uniform(-1000, 1000)))
+            else:
+                row.append(_text(rng, quoting))
+        yield row
+
+
+def write(filename, nrows, columns, *, cardinality, quoting=0.0, numeric=0.5, seed=0):
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(fieldnames(columns, numeric))
+        writer.writerows(
+            rows(
+                nrows,
+                columns,
+                cardinality=cardinality,
+                quoting=quoting,
+                numeric=numeric,
+                seed=seed,
+            )
+        )
+
+
+def write_keys(filename, cardinality, *, seed=0):
+    # A file with one row per key, to be joined with a generated file.
+    rng = random.Random(seed)
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["key", "label"])
+        writer.writerows(["k{}".format(i), _text(rng, 0.0)] for i in range(cardinality))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a deterministic csv file for benchmarks."
+    )
+    parser.add_argument("output", help="Output csv file.")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of rows.")
+    parser.add_argument(
+        "--columns", type=int, default=8, help="Number of columns (with the key)."
+    )
+    parser.add_argument(
+        "--cardinality", type=int, default=1000, help="Number of distinct keys."
+    )
+    parser.add_argument(
+        "--quoting",
+        type=float,
+        default=0.0,
+        help="Share of text values which need to be quoted.",
+    )
+    parser.add_argument(
+        "--numeric", type=float, default=0.5, help="Share of numeric columns."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+    write(
+        args.output,
+        args.rows,
+        args.columns,
+        cardinality=args.cardinality,
+        quoting=args.quoting,
+        numeric=args.numeric,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/python3
+
+import argparse
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import generate
+
+
+# ru_maxrss is in kilobytes on Linux, in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def _sort_column(data):
+    return "n1" if "n1" in data["fieldnames"] else "key"
+
+
+def _api_input(data, filename="input"):
+    from csvspoon import ContentCsv, CsvFileSpec
+
+    return ContentCsv(filespec=CsvFileSpec(data[filename]))
+
+
+def _api_write(content):
+    with open(os.devnull, "w", newline="") as f:
+        content.write(f)
+
+
+def api_cat(data):
+    _api_write(_api_input(data))
+
+
+def api_apply(data):
+    from csvspoon import Formula
+
+    content = _api_input(data)
+    content.add_apply("upper", Formula("key.upper()", {}))
+    _api_write(content)
+
+
+def api_filter(data):
+    from csvspoon import Formula
+
+    content = _api_input(data)
+    content.add_filter(Formula("key.endswith('1')", {}))
+    _api_write(content)
+
+
+def api_sort(data):
+    _api_write(_api_input(data).sort(keys=["key"]))
+
+
+def api_sort_numeric(data):
+    _api_write(_api_input(data).sort(keys=[_sort_column(data)], numeric=True))
+
+
+def api_sort_jobs(data):
+    _api_write(_api_input(data).sort(keys=["key"], jobs=2))
+
+
+def api_join(data):
+    _api_write(_api_input(data).join(_api_input(data, "keys")))
+
+
+def api_aggregate(data):
+    from csvspoon import AGGREGATION_FUNCTIONS, Formula
+
+    aggregation = Formula("count(key)", dict(AGGREGATION_FUNCTIONS))
+    _api_write(_api_input(data).aggregate(["key"], [("n", aggregation)]))
+
+
+def _cli_main(data, subcommand, *args):
+    from csvspoon import _cli
+
+    args = _cli.build_parser().parse_args([subcommand, "-o", os.devnull] + list(args))
+    args.stats = None
+    getattr(_cli, "main_{}".format(subcommand))(args)
+
+
+def cli_cat(data):
+    _cli_main(data, "cat", data["input"])
+
+
+def cli_apply(data):
+    _cli_main(data, "apply", "-a", "upper", "key.upper()", data["input"])
+
+
+def cli_filter(data):
+    _cli_main(data, "filter", "-a", "key.endswith('1')", data["input"])
+
+
+def cli_sort(data):
+    _cli_main(data, "sort", "-k", "key", data["input"])
+
+
+def cli_sort_numeric(data):
+    _cli_main(data, "sort", "-n", "-k", _sort_column(data), data["input"])
+
+
+def cli_sort_jobs(data):
+    _cli_main(data, "sort", "-j", "2", "-k", "key", data["input"])
+
+
+def cli_join(data):
+    _cli_main(data, "join", data["input"], data["keys"])
+
+
+def cli_aggregate(data):
+    _cli_main(data, "aggregate", "-k", "key", "-a", "n", "count(key)", data["input"])
+
+
+BENCHMARKS = {
+    func.__name__: func
+    for func in (
+        api_cat,
+        api_apply,
+        api_filter,
+        api_sort,
+        api_sort_numeric,
+        api_sort_jobs,
+        api_join,
+        api_aggregate,
+        cli_cat,
+        cli_apply,
+        cli_filter,
+        cli_sort,
+        cli_sort_numeric,
+        cli_sort_jobs,
+        cli_join,
+        cli_aggregate,
+    )
+}
+
+
+def _maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT
+
+
+def _measure(name, data, repeat):
+    # Run in a fresh process, so that the peak memory of a benchmark is not
+    # the one of a previous benchmark. The imports are not measured.
+    importlib.import_module("csvspoon._cli")
+
+    baseline = _maxrss()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        BENCHMARKS[name](data)
+        times.append(time.perf_counter() - start)
+    peak = _maxrss()
+    return {
+        "name": name,
+        "rows": data["rows"],
+        "seconds": min(times),
+        "rows_per_sec": data["rows"] / min(times),
+        "peak_memory": peak,
+        "memory_increase": peak - baseline,
+    }
+
+
+def _send_measure(connection, name, data, repeat):
+    # not a pool worker: daemonic processes cannot start the processes of
+    # sort --jobs
+    with connection:
+        connection.send(_measure(name, data, repeat))
+
+
+def run(names, data, repeat):
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in names:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_send_measure, args=(sender, name, data, repeat)
+        )
+        process.start()
+        sender.close()
+        with receiver:
+            result = receiver.recv()
+        process.join()
+        print(
+            "{name:<20} {seconds:8.3f} s {rows_per_sec:12.0f} rows/s"
+            " {peak_memory:12d} B".format(**result),
+            file=sys.stderr,
+        )
+        results.append(result)
+    return results
+
+
+def compare(results, reference, threshold):
+    # Return the names of the benchmarks at least threshold slower (relative)
+    # than in the reference run.
+    reference = {result["name"]: result for result in reference["results"]}
+    regressions = []
+    for result in results:
+        ref = reference.get(result["name"])
+        if ref is None:
+            continue
+        ratio = result["rows_per_sec"] / ref["rows_per_sec"]
+        memory_ratio = result["peak_memory"] / ref["peak_memory"]
+        print(
+            "{:<20} speed x{:.2f} peak memory x{:.2f}".format(
+                result["name"], ratio, memory_ratio
+            ),
+            file=sys.stderr,
+        )
+        if ratio < 1 - threshold:
+            regressions.append(result["name"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="""
+            Run csvspoon benchmarks on generated csv files, and save the
+            results (rows/sec and peak memory) as JSON.
+            """
+    )
+    parser.add_argument("--rows", type=int, default=100000, help="Number of rows.")
+    parser.add_argument(
+        "--columns", type=int, default=8, help="Number of columns (with the key)."
+    )
+    parser.add_argument(
+        "--cardinality", type=int, default=1000, help="Number of distinct keys."
+    )
+    parser.add_argument(
+        "--quoting",
+        type=float,
+        default=0.0,
+        help="Share of text values which need to be quoted.",
+    )
+    parser.add_argument(
+        "--numeric", type=float, default=0.5, help="Share of numeric columns."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of runs of each benchmark, the fastest is kept.",
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        dest="benchmarks",
+        action="append",
+        choices=tuple(BENCHMARKS),
+        help="Benchmark to run. Can be specified multiple time. (default: all)",
+    )
+    parser.add_argument("-o", "--output", help="Output JSON file. (default: stdout)")
+    parser.add_argument(
+        "--compare",
+        metavar="JSON",
+        help="""
+            Results of a previous run. Exit with an error if a benchmark is
+            slower than in this run by more than --threshold.
+            """,
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown considered as a regression. (default: 0.1)",
+    )
+    args = parser.parse_args()
+
+    params = {
+        "rows": args.rows,
+        "columns": args.columns,
+        "cardinality": args.cardinality,
+        "quoting": args.quoting,
+        "numeric": args.numeric,
+        "seed": args.seed,
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data = {
+            "input": os.path.join(tmpdir, "input.csv"),
+            "keys": os.path.join(tmpdir, "keys.csv"),
+            "rows": args.rows,
+            "fieldnames": generate.fieldnames(args.columns, args.numeric),
+        }
+        generate.write(
+            data["input"],
+            args.rows,
+            args.columns,
+            cardinality=args.cardinality,
+            quoting=args.quoting,
+            numeric=args.numeric,
+            seed=args.seed,
+        )
+        generate.write_keys(data["keys"], args.cardinality, seed=args.seed)
+        results = run(args.benchmarks or tuple(BENCHMARKS), data, args.repeat)
+
+    import csvspoon
+
+    output = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "csvspoon": csvspoon.__version__,
+        "params": params,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output is None:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+            f.write("\n")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("Regressions: {}".format(", ".join(regressions)), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+COMMANDS = {
+    "help": ["--help"],
+    "cat": ["cat", "{input}"],
+    "apply": ["apply", "-a", "z", "a+b", "{input}"],
+    "filter": ["filter", "-a", "a>b", "{input}"],
+    "sort": ["sort", "-k", "a", "{input}"],
+    "join": ["join", "{input}", "{input}"],
+    "aggregate": ["aggregate", "-k", "a", "{input}"],
+}
+
+
+def import_times(module="csvspoon._cli"):
+    # Import times (in microseconds) as reported by python -X importtime: the
+    # self and cumulative times of each imported module.
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_time, cumulative, name = line[len("import time:") :].split("|")
+        if not self_time.strip().isdigit():
+            continue
+        times[name.strip()] = {
+            "self": int(self_time),
+            "cumulative": int(cumulative),
+        }
+    return times
+
+
+def command_time(args, repeat):
+    # Wall time of csvspoon runs (in seconds).
+    argv = [sys.executable, "-c", "from csvspoon._cli import main; main()"] + args
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times)}
+
+
+def compare(results, reference, threshold):
+    # Return the names of the measures at least threshold slower (relative)
+    # than in the reference run.
+    regressions = []
+    pairs = [
+        ("import", results["import"]["total"], reference["import"]["total"]),
+    ]
+    for name, times in results["commands"].items():
+        if name in reference["commands"]:
+            pairs.append((name, times["min"], reference["commands"][name]["min"]))
+    for name, value, ref in pairs:
+        print("{:<20} x{:.2f}".format(name, value / ref), file=sys.stderr)
+        if value > ref * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="""
+            Measure csvspoon startup: import times (as python -X importtime)
+            and wall time of short runs, and save the results as JSON.
+            """
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=20,
+        help="Number of runs of each command. (default: 20)",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=15,
+        help="Number of modules reported, by cumulative import time.",
+    )
+    parser.add_argument("-o", "--output", help="Output JSON file. (default: stdout)")
+    parser.add_argument(
+        "--compare",
+        metavar="JSON",
+        help="""
+            Results of a previous run. Exit with an error if a measure is
+            slower than in this run by more than --threshold.
+            """,
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown considered as a regression. (default: 0.1)",
+    )
+    args = parser.parse_args()
+
+    # the import time is the best of several runs
+    runs = [import_times() for _ in range(min(args.repeat, 5))]
+    best = min(runs, key=lambda times: times["csvspoon._cli"]["cumulative"])
+    modules = sorted(best.items(), key=lambda item: -item[1]["cumulative"])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "input.csv")
+        with open(filename, "w") as f:
+            f.write("a,b\n1,2\n3,4\n")
+        commands = {
+            name: command_time(
+                [arg.format(input=filename) for arg in command], args.repeat
+            )
+            for name, command in COMMANDS.items()
+        }
+    for name, times in commands.items():
+        print("{:<20} {:8.3f} s".format(name, times["min"]), file=sys.stderr)
+
+    import csvspoon
+
+    results = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "csvspoon": csvspoon.__version__,
+        "repeat": args.repeat,
+        "import": {
+            "total": best["csvspoon._cli"]["cumulative"],
+            "modules": dict(modules[: args.top]),
+        },
+        "commands": commands,
+    }
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("Regressions: {}".format(", ".join(regressions)), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -32,21 +32,39 @@ version_info = (1, 0)
 __version__ = ".".join(map(str, version_info))
 
 from .spoon import (
+    AGGREGATION_FUNCTIONS,
     ColFormat,
     ColType,
     ContentCsv,
+    CsvIndex,
+    CsvColumnar,
     CsvColumnsNotFound,
     CsvFileSpec,
+    CsvNotSorted,
+    Formula,
     NewColFormat,
     NotValidContent,
+    Stats,
+    join_plan,
+    open_output,
+    record_ranges,
 )
 
 __all__ = [
+    "AGGREGATION_FUNCTIONS",
     "ColFormat",
     "ColType",
     "ContentCsv",
+    "CsvIndex",
+    "CsvColumnar",
     "CsvColumnsNotFound",
     "CsvFileSpec",
+    "CsvNotSorted",
+    "Formula",
     "NewColFormat",
     "NotValidContent",
+    "Stats",
+    "join_plan",
+    "open_output",
+    "record_ranges",
 ]
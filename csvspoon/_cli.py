@@ -20,20 +20,41 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import functools
-import argcomplete
 import argparse
 import textwrap
+import copy
 import sys
+import io
 import os
 
 from csvspoon import (
+    AGGREGATION_FUNCTIONS,
     ColFormat,
     ColType,
     ContentCsv,
+    CsvIndex,
+    CsvColumnar,
     CsvColumnsNotFound,
     CsvFileSpec,
+    Formula,
     NewColFormat,
     NotValidContent,
+    Stats,
+    join_plan,
+    open_output,
+    record_ranges,
+)
+
+_PARALLEL_RANGE_SIZE = 4 * 2**20
+_OUTPUT_BUFFER = 2**20
+_PIPELINE_SUBCOMMANDS = (
+    "cat",
+    "apply",
+    "filter",
+    "sort",
+    "join",
+    "aggregate",
+    "distinct",
 )
 
 
@@ -51,6 +72,14 @@ class _alternatively_NewColFormat_Formula:
         return typ(value)
 
 
+def _columnar_filename(filename):
+    if not CsvColumnar.is_columnar(filename):
+        raise argparse.ArgumentTypeError(
+            "{!r} has not the suffix of a columnar file".format(filename)
+        )
+    return filename
+
+
 def cli_example_main_doc():
     examples = cli_examples()
     section_doc = {
@@ -60,6 +89,10 @@ def cli_example_main_doc():
         "filter": "Filter CSV from given conditions",
         "join": "Join CSV files",
         "aggregate": "Compute aggregation on CSV file",
+        "distinct": "Remove duplicate rows of CSV file",
+        "index": "Index CSV file for join",
+        "convert": "Convert CSV file to a columnar file",
+        "pipeline": "Chain subcommands in a single process",
     }
     doc = "## Cli example\n"
     for subcommand, section_title in section_doc.items():
@@ -105,6 +138,9 @@ def cli_examples():
             Cat two csv files:
               {command} file1.csv file2.csv
 
+            Recompress a gzip compressed csv file with xz, using 4 threads:
+              {command} --compress-threads 4 -o file.csv.xz file.csv.gz
+
             Reformat two columns of a csv files:
               {command} -f a_colname:5.1f -f another_colname:04d file.csv
 
@@ -123,6 +159,9 @@ def cli_examples():
             Operate two NATURAL JOIN on three csv files:
               {command} file1.csv file2.csv file3.csv
 
+            Operate two NATURAL JOIN on three csv files, letting csvspoon choose the order:
+              {command} -p file1.csv file2.csv file3.csv
+
             Operate LEFT JOIN on two csv files
               {command} -l file1.csv file2.csv
 
@@ -131,6 +170,9 @@ def cli_examples():
 
             Operate OUTER JOIN on two csv files
               {command} -lr file1.csv file2.csv
+
+            Operate JOIN on two large csv files already sorted on the common column:
+              {command} -s file1.csv file2.csv
             """
         ),
         "apply": textwrap.dedent(
@@ -169,6 +211,15 @@ def cli_examples():
 
             Shuffle csv file:
               {command} -R file.csv
+
+            Sort a csv file larger than memory, keeping at most 100000 rows in memory:
+              {command} -S 100000 -k cola file.csv
+
+            Keep the 100 rows with the largest values of numcol:
+              {command} -n -r -k numcol --limit 100 file.csv
+
+            Sort csv file using 4 processes:
+              {command} -j 4 -k cola file.csv
             """
         ),
         "filter": textwrap.dedent(
@@ -193,6 +244,49 @@ def cli_examples():
                       -t z:float \\
                       -a "math.sqrt(x**2+y**2)>z" \\
                       file.csv
+
+            Filter csv file with many filters, evaluating the most selective
+            ones first:
+              {command} \\
+                      --adaptive \\
+                      -t x:float \\
+                      -a "x > 0" \\
+                      -a "name.startswith('A')" \\
+                      -a "len(comment) > 100" \\
+                      file.csv
+            """
+        ),
+        "index": textwrap.dedent(
+            """\
+            Index a reference csv file on column id, then join it without storing
+            it in memory:
+              {command} -k id ref.csv
+              csvspoon join --index file.csv ref.csv
+            """
+        ),
+        "convert": textwrap.dedent(
+            """\
+            Convert a csv file to a columnar file with typed columns, and use it
+            without parsing (typed columns being converted when read):
+              {command} -t price:float -t quantity:int -o file.spoon file.csv
+              csvspoon filter -a "price>12.5" file.spoon
+            """
+        ),
+        "pipeline": textwrap.dedent(
+            """\
+            Filter, compute a new column and aggregate, parsing the csv file only
+            once:
+              {command} \\
+                      filter -t x:float -a "x > 0" file.csv :: \\
+                      apply -t x:float -a y "x**2" :: \\
+                      aggregate -k group -t y:float -a sumy "sum(y)"
+
+            Join the filtered rows of a csv file with another one, and sort the
+            result:
+              {command} \\
+                      filter -a "name != ''" file.csv :: \\
+                      join ref.csv :: \\
+                      sort -k name -o result.csv
             """
         ),
         "aggregate": textwrap.dedent(
@@ -233,34 +327,68 @@ def cli_examples():
                       -a stdgrade "np.std(grade)" \\
                       -k group \\
                       file.csv
+
+            Computing the mean grade and the grade range by group, without
+            storing the whole file in memory:
+              {command} \\
+                      -t grade:float \\
+                      -a meangrade "mean(grade)" \\
+                      -a rangegrade "max(grade)-min(grade)" \\
+                      -k group \\
+                      file.csv
             """
         ),
-    }
-    return examples
-
+        "distinct": textwrap.dedent(
+            """\
+            Remove duplicate rows, keeping the first occurrence:
+              {command} \\
+                      file.csv
 
-def parseargs():
-    epilogs = {
-        subcommand: (
-            "Examples:\n" + textwrap.indent(example, " " * 2).format(command="%(prog)s")
-        )
-        for subcommand, example in cli_examples().items()
-    }
+            Keep the first row for each value of a column:
+              {command} \\
+                      -k id \\
+                      file.csv
 
-    parser = argparse.ArgumentParser(
-        description=textwrap.dedent(
-            """
-            A tool to manipulate csv files with headers.
-            Again, again and again.
+            Remove duplicate events of a large log, storing at most 1000000
+            keys in memory (the order of rows is then not kept):
+              {command} \\
+                      -k id \\
+                      -k date \\
+                      -S 1000000 \\
+                      events.csv.gz
             """
         ),
-        epilog="",
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-    )
-    parser.add_argument(
-        "--version", action="version", version="", help=argparse.SUPPRESS
-    )
+    }
+    return examples
+
+
+_INPUT_FILESPEC_HELP = """
+        Input file specification. {} Can be a filename (e.g. "file.csv"), a
+        filename followed a semicolon and column names separated by commas (e.g.
+        "file.csv:a_colname,another_colname"). A column can be renamed while
+        reading the file (e.g. "file.csv:a_colname,new_colname=old_colname").
+        When column names are specified, only these columns are used, with the
+        provided order. A columnar file written by "convert" (with the suffix
+        ".spoon") can also be used. Files with the suffix ".gz", ".bz2", ".xz"
+        or ".zst" are decompressed (in a background thread).
+        """
 
+_SUBCOMMAND_HELPS = {
+    "cat": "Concatenate csv files.",
+    "apply": "Apply a formula to compute a new column.",
+    "filter": "Filter a csv with a formula.",
+    "sort": "Sort csv files.",
+    "join": "Operate join on csv files",
+    "index": "Build an index of a csv file for join.",
+    "convert": "Convert a csv file to a columnar file.",
+    "aggregate": "Apply a aggregation formula to compute a new column.",
+    "distinct": "Remove duplicate rows of a csv file.",
+    "pipeline": "Chain subcommands in a single process.",
+}
+
+
+def _parent_parsers():
+    # Arguments shared by subcommands.
     common_parser = argparse.ArgumentParser(add_help=False)
     common_parser.add_argument(
         "-d",
@@ -277,7 +405,26 @@ def parseargs():
         help="Input encoding. (default: 'utf8')",
     )
     common_parser.add_argument(
-        "-o", "--output", dest="output", help="Output file, else output on stdout."
+        "-o",
+        "--output",
+        dest="output",
+        help="""
+            Output file, else output on stdout. The output is compressed if
+            the filename ends with ".gz", ".bz2", ".xz" or ".zst" (zstandard
+            module needed).
+            """,
+    )
+    common_parser.add_argument(
+        "--compress-threads",
+        dest="compress_threads",
+        type=int,
+        default=1,
+        metavar="THREADS",
+        help="""
+            Number of threads compressing the output file. With more than one
+            thread, the output is compressed by blocks in parallel, written as
+            concatenated streams. (default: 1)
+            """,
     )
     common_parser.add_argument(
         "-u",
@@ -308,6 +455,35 @@ def parseargs():
             """,
     )
 
+    common_parser.add_argument(
+        "--stats",
+        dest="stats_output",
+        action="store_const",
+        const="-",
+        help="""
+            Print statistics on stderr at the end: rows in and out and time
+            spent in each stage (reading, formulas and type conversions, join,
+            aggregate, sort, writing), number of entries of hash tables and
+            peak memory. In a pipeline, the options of the last stage are used. With
+            --jobs, the worker processes are not measured.
+            """,
+    )
+    common_parser.add_argument(
+        "--stats-json",
+        dest="stats_output",
+        metavar="FILE",
+        help="As --stats, statistics being written as JSON in FILE.",
+    )
+    common_parser.add_argument(
+        "--stats-memory",
+        dest="stats_memory",
+        action="store_true",
+        help="""
+            With --stats, also trace the peak of memory allocated by python
+            (with tracemalloc, which is slow).
+            """,
+    )
+
     coltyped_parser = argparse.ArgumentParser(add_help=False)
     coltyped_parser.add_argument(
         "-b",
@@ -348,23 +524,29 @@ def parseargs():
             """,
     )
 
-    input_filespec_help = """
-        Input file specification. {} Can be a filename (e.g. "file.csv"), a
-        filename followed a semicolon and column names separated by commas (e.g.
-        "file.csv:a_colname,another_colname"). A column can be renamed while
-        reading the file (e.g. "file.csv:a_colname,new_colname=old_colname").
-        When column names are specified, only these columns are used, with the
-        provided order.
-        """
-
-    subparsers = parser.add_subparsers(
-        dest="subcommand", title="subcommands", required=True
+    parallel_parser = argparse.ArgumentParser(add_help=False)
+    parallel_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="""
+            Number of processes used. If greater than 1 and input is a file
+            (not stdin), the file is split in parts processed in parallel,
+            the output order being kept. (default: 1)
+            """,
     )
+    return {
+        "common": common_parser,
+        "coltyped": coltyped_parser,
+        "parallel": parallel_parser,
+    }
+
 
-    # cat
-    parser_cat = subparsers.add_parser(
+def _add_cat_parser(subparsers, parents, epilog):
+    parser = subparsers.add_parser(
         "cat",
-        help="Concatenate csv files.",
+        help=_SUBCOMMAND_HELPS["cat"],
         description=textwrap.dedent(
             """
             Concatenate csv files.
@@ -372,13 +554,13 @@ def parseargs():
             This method is completely streamed and no data is stored in memory.
             """
         ),
-        parents=(common_parser,),
-        epilog=epilogs["cat"],
+        parents=(parents["common"],),
+        epilog=epilog,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    parser_cat.add_argument(
+    parser.add_argument(
         "input",
-        help=input_filespec_help.format(
+        help=_INPUT_FILESPEC_HELP.format(
             """
             If no input file is provided, stdin is used as first input file,
             otherwise use explicitly "-" for stdin.
@@ -388,22 +570,28 @@ def parseargs():
         type=CsvFileSpec,
     )
 
-    # apply
-    parser_apply = subparsers.add_parser(
+
+def _add_apply_parser(subparsers, parents, epilog):
+    parser = subparsers.add_parser(
         "apply",
-        help="Apply a formula to compute a new column.",
+        help=_SUBCOMMAND_HELPS["apply"],
         description=textwrap.dedent(
             """
             Apply a formula to compute a new column.
             The formula must be a valid python expression evaluated on each row.
             This method is completely streamed and no data is stored in memory.
+            With --jobs, the input file is processed in parallel.
             """
         ),
-        parents=(common_parser, coltyped_parser),
-        epilog=epilogs["apply"],
+        parents=(
+            parents["common"],
+            parents["coltyped"],
+            parents["parallel"],
+        ),
+        epilog=epilog,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    parser_apply.add_argument(
+    parser.add_argument(
         "-a",
         "--add",
         "--add-column",
@@ -425,9 +613,9 @@ def parseargs():
             Can be specified multiple time.
             """,
     )
-    parser_apply.add_argument(
+    parser.add_argument(
         "input",
-        help=input_filespec_help.format(
+        help=_INPUT_FILESPEC_HELP.format(
             """
             If no input file is provided, stdin is used as input file.
             """
@@ -436,23 +624,29 @@ def parseargs():
         nargs="?",
     )
 
-    # filter
-    parser_filter = subparsers.add_parser(
+
+def _add_filter_parser(subparsers, parents, epilog):
+    parser = subparsers.add_parser(
         "filter",
-        help="Filter a csv with a formula.",
+        help=_SUBCOMMAND_HELPS["filter"],
         description=textwrap.dedent(
             """
             Evaluate a formula on each row, and keep only rows where the formula
             is evaluated True.
             The formula must be a valid python expression evaluated on each row.
             This method is completely streamed and no data is stored in memory.
+            With --jobs, the input file is processed in parallel.
             """
         ),
-        parents=(common_parser, coltyped_parser),
-        epilog=epilogs["filter"],
+        parents=(
+            parents["common"],
+            parents["coltyped"],
+            parents["parallel"],
+        ),
+        epilog=epilog,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    parser_filter.add_argument(
+    parser.add_argument(
         "-a",
         "--add",
         "--add-filter",
@@ -468,9 +662,19 @@ def parseargs():
             be specified multiple time.
             """,
     )
-    parser_filter.add_argument(
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="""
+            Reorder filters while reading the input, so that the cheapest and
+            most selective ones, measured on a sample of rows, are evaluated
+            first. A filter must then not rely on the previous ones to be
+            evaluated (e.g. "x != 0" then "1 / x > 2").
+            """,
+    )
+    parser.add_argument(
         "input",
-        help=input_filespec_help.format(
+        help=_INPUT_FILESPEC_HELP.format(
             """
             If no input file is provided, stdin is used as input file.
             """
@@ -479,21 +683,23 @@ def parseargs():
         nargs="?",
     )
 
-    # sort
-    parser_sort = subparsers.add_parser(
+
+def _add_sort_parser(subparsers, parents, epilog):
+    parser = subparsers.add_parser(
         "sort",
-        help="Sort csv files.",
+        help=_SUBCOMMAND_HELPS["sort"],
         description=textwrap.dedent(
             """
             Sort csv file.
-            Warning: this method need to store in memory all the input csv file.
+            Warning: this method need to store in memory all the input csv file,
+                unless --buffer-size is specified.
             """
         ),
-        parents=(common_parser,),
-        epilog=epilogs["sort"],
+        parents=(parents["common"],),
+        epilog=epilog,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    parser_sort.add_argument(
+    parser.add_argument(
         "-k",
         "--key",
         dest="keys",
@@ -502,21 +708,21 @@ def parseargs():
             Column used for sorting. Can be specified multiple time.
             """,
     )
-    parser_sort.add_argument(
+    parser.add_argument(
         "-n",
         "--numeric-sort",
         dest="numeric",
         action="store_true",
         help="Compare according to numerical value.",
     )
-    parser_sort.add_argument(
+    parser.add_argument(
         "-r",
         "--reverse",
         dest="reverse",
         action="store_true",
         help="Reverse the result of comparisons.",
     )
-    parser_sort.add_argument(
+    parser.add_argument(
         "-R",
         "--random-sort",
         dest="random",
@@ -526,9 +732,42 @@ def parseargs():
             the same key.
             """,
     )
-    parser_sort.add_argument(
+    parser.add_argument(
+        "-S",
+        "--buffer-size",
+        dest="buffer_size",
+        type=int,
+        metavar="ROWS",
+        help="""
+            Maximal number of rows stored in memory. If the input is larger,
+            sorted runs of this size are written in temporary files and merged
+            (external sort).
+            """,
+    )
+    parser.add_argument(
+        "--limit",
+        dest="limit",
+        type=int,
+        metavar="ROWS",
+        help="""
+            Output only the first ROWS rows of the sorted file, keeping only
+            ROWS rows in memory (--buffer-size and --jobs are then ignored).
+            """,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="""
+            Number of processes used. If greater than 1, chunks of rows are
+            sorted in parallel and merged. With --buffer-size, the chunks
+            waiting to be sorted share the buffer. (default: 1)
+            """,
+    )
+    parser.add_argument(
         "input",
-        help=input_filespec_help.format(
+        help=_INPUT_FILESPEC_HELP.format(
             """
             If no input file is provided, stdin is used as input file.
             """
@@ -537,26 +776,28 @@ def parseargs():
         nargs="?",
     )
 
-    # join
-    parser_join = subparsers.add_parser(
+
+def _add_join_parser(subparsers, parents, epilog):
+    parser = subparsers.add_parser(
         "join",
-        help="Operate join on csv files",
+        help=_SUBCOMMAND_HELPS["join"],
         description=textwrap.dedent(
             """
             Natural join of csv files.
             Joins are performed from left to right.
             Warning: this method need to store in memory all csv except the
-                first which is streamed.
+                first which is streamed, unless --sorted, --buffer-size or
+                --index is used.
 
             If neither --left or --right specified, inner join is realized. For
             complete outer join, use --left and --right together.
             """
         ),
-        parents=(common_parser,),
-        epilog=epilogs["join"],
+        parents=(parents["common"],),
+        epilog=epilog,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    parser_join.add_argument(
+    parser.add_argument(
         "-l",
         "--left",
         action="store_true",
@@ -565,7 +806,7 @@ def parseargs():
             a left join. Can be used with `-r` to obtain a outer join.
             """,
     )
-    parser_join.add_argument(
+    parser.add_argument(
         "-r",
         "--right",
         action="store_true",
@@ -574,7 +815,7 @@ def parseargs():
             a right join. Can be used with `-l` to obtain a outer join.
             """,
     )
-    parser_join.add_argument(
+    parser.add_argument(
         "-e",
         "--empty",
         action="store_true",
@@ -582,9 +823,57 @@ def parseargs():
             Indicate than empty field have to be considered as a value.
             """,
     )
-    parser_join.add_argument(
+    parser.add_argument(
+        "-s",
+        "--sorted",
+        dest="sorted",
+        action="store_true",
+        help="""
+            Indicate that input files are sorted on the common columns (in the
+            order of the columns of the first file, as given by "sort -k"), a
+            merge join is then performed, storing in memory only rows with the
+            same values of common columns. Unmatched rows of right join are
+            output in key order. An error is raised if a file is not sorted.
+            """,
+    )
+    parser.add_argument(
+        "-S",
+        "--buffer-size",
+        dest="buffer_size",
+        type=int,
+        metavar="ROWS",
+        help="""
+            Maximal number of rows of a joined file stored in memory. If a file
+            is larger, both inputs are partitioned in temporary files on the
+            values of common columns, and partitions are joined separately. The
+            order of rows is not kept.
+            """,
+    )
+    parser.add_argument(
+        "--index",
+        dest="use_index",
+        action="store_true",
+        help="""
+            Use the up to date index (see "index") of a joined file on the
+            common columns, if any, instead of storing the file in memory. Only
+            matching rows are read, which is faster only if few rows of the
+            first file are joined.
+            """,
+    )
+    parser.add_argument(
+        "-p",
+        "--plan",
+        action="store_true",
+        help="""
+            For inner join, choose the join order from the file sizes: the
+            largest file is streamed and the smallest ones are stored in memory
+            first. The columns are the same, but the order of rows is not kept.
+            Ignored with --left, --right or --sorted.
+            """,
+    )
+    parser.add_argument(
         "input",
-        help=input_filespec_help.format(
+        help=_INPUT_FILESPEC_HELP.format(
             """
             If less than two input files are provided, stdin is used as first
             input file, otherwise use explicitly "-" for stdin.
@@ -594,24 +883,141 @@ def parseargs():
         type=CsvFileSpec,
     )
 
-    # aggregate
-    parser_aggregate = subparsers.add_parser(
+
+def _add_index_parser(subparsers, parents, epilog):
+    parser = subparsers.add_parser(
+        "index",
+        help=_SUBCOMMAND_HELPS["index"],
+        description=textwrap.dedent(
+            """
+            Build an index of a csv file on key columns, written next to the
+            file (with the suffix ".spoonidx"). When this file is joined with
+            --index (not as the first input) on the same columns, the index is
+            used instead of storing the file in memory, only matching rows are
+            read.
+            The index is ignored if the file is modified.
+            """
+        ),
+        epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "-d",
+        "--delim",
+        dest="delim",
+        default=",",
+        help="Input delimiter. (default: ',')",
+    )
+    parser.add_argument(
+        "-c",
+        "--inputenc",
+        dest="inputenc",
+        default="utf8",
+        help="Input encoding. (default: 'utf8')",
+    )
+    parser.add_argument(
+        "-k",
+        "--key",
+        dest="keys",
+        action="append",
+        required=True,
+        help="""
+            Column used as key of the index. Can be specified multiple time.
+            """,
+    )
+    parser.add_argument(
+        "input",
+        help="Input file (stdin can not be indexed).",
+    )
+
+
+def _add_convert_parser(subparsers, parents, epilog):
+    parser = subparsers.add_parser(
+        "convert",
+        help=_SUBCOMMAND_HELPS["convert"],
+        description=textwrap.dedent(
+            """
+            Convert a csv file to a columnar file, which can be used as input
+            of other subcommands (with the suffix ".spoon"). The texts of each
+            column are stored by chunks of rows, or dictionary encoded if it is
+            smaller, and are read back unchanged. The file is memory mapped when
+            read, no parsing is needed and only the used columns are read.
+            """
+        ),
+        epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "-d",
+        "--delim",
+        dest="delim",
+        default=",",
+        help="Input delimiter. (default: ',')",
+    )
+    parser.add_argument(
+        "-c",
+        "--inputenc",
+        dest="inputenc",
+        default="utf8",
+        help="Input encoding. (default: 'utf8')",
+    )
+    parser.add_argument(
+        "-t",
+        "--type",
+        action="append",
+        type=ColType,
+        default=[],
+        help="""
+            Type of a column, int or float (other columns are strings). The
+            values are checked, and converted when the file is read as with
+            --type, missing values being empty strings. The argument must be a
+            column name followed by a colon and the type. e.g. "a_column:int".
+            This option can be specified multiple time to type different
+            columns.
+            """,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        required=True,
+        type=_columnar_filename,
+        help='Output file, with the suffix ".spoon".',
+    )
+    parser.add_argument(
+        "input",
+        help=_INPUT_FILESPEC_HELP.format(
+            """
+            If no input file is provided, stdin is used as input file.
+            """
+        ),
+        type=CsvFileSpec,
+        nargs="?",
+    )
+
+
+def _add_aggregate_parser(subparsers, parents, epilog):
+    parser = subparsers.add_parser(
         "aggregate",
-        help="Apply a aggregation formula to compute a new column.",
+        help=_SUBCOMMAND_HELPS["aggregate"],
         description=textwrap.dedent(
             """
             Apply a formula to compute a new column.
             The formula must be a valid python expression evaluated for each
             groupped row.
             Only aggregation or column with non ambiguous values are keeped.
-            Warning: this method need to store in memory all the input csv file.
+            Formulas only using the aggregation functions len, count, sum, min,
+            max, mean, variance, first and last applied directly on columns
+            (e.g. "sum(a)/len(a)") are computed incrementally.
+            Warning: the values of the columns used by other formulas are stored
+                in memory.
             """
         ),
-        parents=(common_parser, coltyped_parser),
-        epilog=epilogs["aggregate"],
+        parents=(parents["common"], parents["coltyped"]),
+        epilog=epilog,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    parser_aggregate.add_argument(
+    parser.add_argument(
         "-a",
         "--add",
         "--add-aggregation",
@@ -629,11 +1035,13 @@ def parseargs():
             accessible as local variable. The formula should return a single
             value.
             e.g. "sum(a_colname) + sum(other_colname)".
+            In addition to python builtins, the functions count, mean, variance
+            (population variance), first and last can be used.
             See "--type" for typing other columns and "--before" for run code
             before evaluating expression. Can be specified multiple time.
             """,
     )
-    parser_aggregate.add_argument(
+    parser.add_argument(
         "-k",
         "--key",
         dest="keys",
@@ -643,9 +1051,58 @@ def parseargs():
             Similar to "GROUP BY" in SQL.
             """,
     )
-    parser_aggregate.add_argument(
+    parser.add_argument(
+        "input",
+        help=_INPUT_FILESPEC_HELP.format(
+            """
+            If no input file is provided, stdin is used as input file.
+            """
+        ),
+        type=CsvFileSpec,
+        nargs="?",
+    )
+
+
+def _add_distinct_parser(subparsers, parents, epilog):
+    parser = subparsers.add_parser(
+        "distinct",
+        help=_SUBCOMMAND_HELPS["distinct"],
+        description=textwrap.dedent(
+            """
+            Remove duplicate rows, only the first row with given values of key
+            columns (all columns by default) being written. Rows are streamed,
+            only the set of keys already seen being stored in memory.
+            """
+        ),
+        parents=(parents["common"],),
+        epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "-k",
+        "--key",
+        dest="keys",
+        action="append",
+        help="""
+            Column used to compare rows. Can be specified multiple time.
+            (default: all columns)
+            """,
+    )
+    parser.add_argument(
+        "-S",
+        "--buffer-size",
+        dest="buffer_size",
+        type=int,
+        metavar="KEYS",
+        help="""
+            Maximal number of keys stored in memory. If there are more distinct
+            keys, the rows with keys not seen yet are partitioned in temporary
+            files and processed separately, and their order is not kept.
+            """,
+    )
+    parser.add_argument(
         "input",
-        help=input_filespec_help.format(
+        help=_INPUT_FILESPEC_HELP.format(
             """
             If no input file is provided, stdin is used as input file.
             """
@@ -654,19 +1111,227 @@ def parseargs():
         nargs="?",
     )
 
-    argcomplete.autocomplete(parser)
+
+def _add_pipeline_parser(subparsers, parents, epilog):
+    parser = subparsers.add_parser(
+        "pipeline",
+        help=_SUBCOMMAND_HELPS["pipeline"],
+        description=textwrap.dedent(
+            """
+            Chain subcommands (cat, apply, filter, sort, join, aggregate,
+            distinct) in a single process, rows being passed from a stage to
+            the next one without writing and parsing csv. Stages are separated by "::", each
+            stage being the arguments of a subcommand.
+            Only the first stage can have an input file, the output of a stage
+            is the input of the next one (the first input for join and cat,
+            other inputs are given as arguments). Only the output options of
+            the last stage are used, except --format which is applied on the
+            output of each stage. Stages are not run in parallel (--jobs of
+            apply and filter is ignored).
+            """
+        ),
+        epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "stages",
+        nargs=argparse.REMAINDER,
+        metavar="STAGE",
+        help="""
+            Subcommand and its arguments. Stages are separated by "::".
+            """,
+    )
+
+
+_SUBCOMMAND_PARSERS = {
+    "cat": _add_cat_parser,
+    "apply": _add_apply_parser,
+    "filter": _add_filter_parser,
+    "sort": _add_sort_parser,
+    "join": _add_join_parser,
+    "index": _add_index_parser,
+    "convert": _add_convert_parser,
+    "aggregate": _add_aggregate_parser,
+    "distinct": _add_distinct_parser,
+    "pipeline": _add_pipeline_parser,
+}
+
+
+def build_parser(subcommands=None):
+    # Only the parsers of the given subcommands (all if None) are built, other
+    # subcommands are only listed.
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(
+            """
+            A tool to manipulate csv files with headers.
+            Again, again and again.
+            """
+        ),
+        epilog="",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--version", action="version", version="", help=argparse.SUPPRESS
+    )
+
+    subparsers = parser.add_subparsers(
+        dest="subcommand", title="subcommands", required=True
+    )
+
+    if subcommands is None:
+        subcommands = _SUBCOMMAND_HELPS
+    parents = examples = None
+    for subcommand, add_parser in _SUBCOMMAND_PARSERS.items():
+        if subcommand not in subcommands:
+            subparsers.add_parser(subcommand, help=_SUBCOMMAND_HELPS[subcommand])
+            continue
+        if parents is None:
+            parents = _parent_parsers()
+            examples = cli_examples()
+        epilog = "Examples:\n" + textwrap.indent(examples[subcommand], " " * 2).format(
+            command="%(prog)s"
+        )
+        add_parser(subparsers, parents, epilog)
+    return parser
+
+
+def parseargs():
+    if "_ARGCOMPLETE" in os.environ:
+        # completion, all parsers are needed
+        import argcomplete
+
+        parser = build_parser()
+        argcomplete.autocomplete(parser)
+    else:
+        # the main parser has no option taking a value, the first positional
+        # argument is the subcommand
+        subcommand = next((arg for arg in sys.argv[1:] if arg[:1] != "-"), None)
+        parser = build_parser(() if subcommand is None else (subcommand,))
     args = parser.parse_args()
     return args
 
 
+def new_stats(args):
+    if getattr(args, "stats_output", None) is None:
+        return None
+    return Stats(trace_memory=args.stats_memory)
+
+
+def write_stats(args):
+    if args.stats is None:
+        return
+    if args.stats_output == "-":
+        args.stats.write(sys.stderr)
+    else:
+        import json
+
+        with open(args.stats_output, "w") as f:
+            json.dump(args.stats.summary(), f, indent=2)
+            f.write("\n")
+
+
+def output_file(args):
+    if args.output:
+        return open_output(
+            args.output, encoding=args.outputenc, threads=args.compress_threads
+        )
+    try:
+        interactive = sys.stdout.isatty()
+        fileno = sys.stdout.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return sys.stdout
+    if interactive:
+        return sys.stdout
+    # stdout with a larger buffer, the file descriptor being kept open
+    sys.stdout.flush()
+    return open(
+        fileno,
+        "w",
+        buffering=_OUTPUT_BUFFER,
+        encoding=sys.stdout.encoding,
+        errors=sys.stdout.errors,
+        closefd=False,
+    )
+
+
+def close_output(f):
+    if f is not sys.stdout:
+        f.close()
+
+
 def write_result(args, result):
-    result.write(
-        open(args.output, mode="w", encoding=args.outputenc)
-        if args.output
-        else sys.stdout,
-        delim=args.odelim,
-        fmt=args.format,
+    f = output_file(args)
+    result.write(f, delim=args.odelim, fmt=args.format)
+    close_output(f)
+
+
+def _write_byte_range(job):
+    args, build, byte_range = job
+    result = build(
+        args,
+        ContentCsv(
+            filespec=args.input,
+            delim=args.delim,
+            encoding=args.inputenc,
+            _byte_range=byte_range,
+        ),
+    )
+    f = io.StringIO()
+    result.write(f, delim=args.odelim, fmt=args.format, header=False)
+    return f.getvalue()
+
+
+def write_streamed(args, build):
+    # build(args, input_csv) must return the result, and may modify args (the
+    # job args are copied before).
+    ranges = None
+    if (
+        args.jobs > 1
+        and args.input.filename != "-"
+        and not CsvColumnar.is_columnar(args.input.filename)
+    ):
+        try:
+            ranges = record_ranges(
+                args.input.filename, _PARALLEL_RANGE_SIZE, encoding=args.inputenc
+            )
+        except ValueError:
+            pass
+    if ranges is None:
+        result = build(
+            args,
+            ContentCsv(
+                filespec=args.input,
+                delim=args.delim,
+                encoding=args.inputenc,
+                stats=args.stats,
+            ),
+        )
+        write_result(args, result)
+        return
+
+    import multiprocessing
+
+    job_args = copy.deepcopy(args)
+    # stats are only collected in the main process
+    job_args.stats = None
+    result = build(
+        args,
+        ContentCsv(
+            filespec=args.input,
+            delim=args.delim,
+            encoding=args.inputenc,
+            stats=args.stats,
+            _byte_range=(0, 0),
+        ),
     )
+    f = output_file(args)
+    result.write(f, delim=args.odelim, fmt=args.format)
+    with multiprocessing.Pool(args.jobs) as pool:
+        for output in pool.imap(
+            _write_byte_range, ((job_args, build, r) for r in ranges)
+        ):
+            f.write(output)
+    close_output(f)
 
 
 def coltyped_common(args, inputstream):
@@ -686,13 +1351,10 @@ def coltyped_common(args, inputstream):
     return fake_global
 
 
-def main_aggregate(args):
-    if args.input is None:
-        args.input = CsvFileSpec("-")
-    input_csv = ContentCsv(
-        filespec=args.input, delim=args.delim, encoding=args.inputenc
-    )
+def build_aggregate(args, input_csv):
     fake_global = coltyped_common(args, input_csv)
+    for name, func in AGGREGATION_FUNCTIONS.items():
+        fake_global.setdefault(name, func)
     if args.added is None:
         args.added = []
 
@@ -700,29 +1362,64 @@ def main_aggregate(args):
         args.format.insert(0, colspec)
 
     aggregations = [
-        (
-            colspec.colname,
-            (lambda f: lambda store: eval(f, fake_global, store))(formula),
-        )
+        (colspec.colname, Formula(formula, fake_global))
         for colspec, formula in args.added
     ]
 
-    result = input_csv.aggregate(keys=args.keys, aggregations=aggregations)
-    write_result(args, result)
+    return input_csv.aggregate(keys=args.keys, aggregations=aggregations)
 
 
-def main_sort(args):
+def main_aggregate(args):
+    if args.input is None:
+        args.input = CsvFileSpec("-")
+    input_csv = ContentCsv(
+        filespec=args.input, delim=args.delim, encoding=args.inputenc, stats=args.stats
+    )
+    write_result(args, build_aggregate(args, input_csv))
+
+
+def build_distinct(args, input_csv):
+    return input_csv.distinct(keys=args.keys, buffer_size=args.buffer_size)
+
+
+def main_distinct(args):
     if args.input is None:
         args.input = CsvFileSpec("-")
-    result = ContentCsv(
-        filespec=args.input, delim=args.delim, encoding=args.inputenc
-    ).sort(
+    input_csv = ContentCsv(
+        filespec=args.input, delim=args.delim, encoding=args.inputenc, stats=args.stats
+    )
+    write_result(args, build_distinct(args, input_csv))
+
+
+def build_sort(args, input_csv):
+    return input_csv.sort(
         keys=args.keys,
         numeric=args.numeric,
         reverse=args.reverse,
         random_sort=args.random,
+        buffer_size=args.buffer_size,
+        limit=args.limit,
+        jobs=args.jobs,
+    )
+
+
+def main_sort(args):
+    if args.input is None:
+        args.input = CsvFileSpec("-")
+    input_csv = ContentCsv(
+        filespec=args.input, delim=args.delim, encoding=args.inputenc, stats=args.stats
     )
-    write_result(args, result)
+    write_result(args, build_sort(args, input_csv))
+
+
+def build_filter(args, input_csv):
+    fake_global = coltyped_common(args, input_csv)
+
+    for formula in args.added:
+        input_csv.add_filter(func=Formula(formula, fake_global))
+    if args.adaptive:
+        input_csv.set_adaptive()
+    return input_csv
 
 
 def main_filter(args):
@@ -730,13 +1427,19 @@ def main_filter(args):
         args.input = CsvFileSpec("-")
     if args.added is None:
         args.added = []
-    result = ContentCsv(filespec=args.input, delim=args.delim, encoding=args.inputenc)
-    fake_global = coltyped_common(args, result)
+    write_streamed(args, build_filter)
 
-    for formula in args.added:
-        result.add_filter(func=(lambda f: lambda r: eval(f, fake_global, r))(formula))
 
-    write_result(args, result)
+def build_apply(args, input_csv):
+    fake_global = coltyped_common(args, input_csv)
+
+    for colspec, formula in args.added:
+        input_csv.add_apply(
+            colname=colspec.colname,
+            func=Formula(formula, fake_global),
+        )
+        args.format.insert(0, colspec)
+    return input_csv
 
 
 def main_apply(args):
@@ -744,47 +1447,169 @@ def main_apply(args):
         args.input = CsvFileSpec("-")
     if args.added is None:
         args.added = []
-    result = ContentCsv(filespec=args.input, delim=args.delim, encoding=args.inputenc)
-    fake_global = coltyped_common(args, result)
+    write_streamed(args, build_apply)
 
-    for colspec, formula in args.added:
-        result.add_apply(
-            colname=colspec.colname,
-            func=(lambda f: lambda r: eval(f, fake_global, r))(formula),
+
+def build_join(args, inputs, sizes):
+    # sizes are the sizes of inputs, None if unknown.
+    planned = args.plan and not (args.left or args.right or args.sorted)
+    if planned:
+        fieldnames = functools.reduce(
+            lambda x, y: x + [k for k in y if k not in x],
+            (list(input_csv.fieldnames) for input_csv in inputs),
         )
-        args.format.insert(0, colspec)
+        order = join_plan([input_csv.fieldnames for input_csv in inputs], sizes)
+        inputs = [inputs[i] for i in order]
+    result = functools.reduce(
+        lambda x, y: x.join(
+            y,
+            left=args.left,
+            right=args.right,
+            empty=args.empty,
+            sorted_input=args.sorted,
+            buffer_size=args.buffer_size,
+            use_index=args.use_index,
+        ),
+        inputs,
+    )
+    if planned:
+        result = result.select(fieldnames)
+    return result
+
 
-    write_result(args, result)
+def file_sizes(filespecs):
+    return [
+        None if fn.filename == "-" else os.path.getsize(fn.filename) for fn in filespecs
+    ]
 
 
 def main_join(args):
     if len(args.input) < 2:
         args.input.insert(0, CsvFileSpec("-"))
-    result = functools.reduce(
-        lambda x, y: x.join(y, left=args.left, right=args.right, empty=args.empty),
-        (
-            ContentCsv(filespec=fn, delim=args.delim, encoding=args.inputenc)
-            for fn in args.input
-        ),
+    inputs = [
+        ContentCsv(
+            filespec=fn, delim=args.delim, encoding=args.inputenc, stats=args.stats
+        )
+        for fn in args.input
+    ]
+    write_result(args, build_join(args, inputs, file_sizes(args.input)))
+
+
+def main_index(args):
+    CsvIndex.build(args.input, args.keys, delim=args.delim, encoding=args.inputenc)
+
+
+def main_convert(args):
+    if args.input is None:
+        args.input = CsvFileSpec("-")
+    input_csv = ContentCsv(
+        filespec=args.input, delim=args.delim, encoding=args.inputenc, stats=args.stats
     )
-    write_result(args, result)
+    types = {}
+    for t in args.type:
+        t.build_type({})
+        colname, typ = t.get_coltype
+        types[colname] = typ
+    CsvColumnar.write(args.output, input_csv, types)
+
+
+def build_cat(args, inputs):
+    return functools.reduce(lambda x, y: x.concat(y), inputs)
 
 
 def main_cat(args):
     if len(args.input) == 0:
         args.input.insert(0, CsvFileSpec("-"))
-    result = functools.reduce(
-        lambda x, y: x.concat(y),
-        (
-            ContentCsv(filespec=fn, delim=args.delim, encoding=args.inputenc)
-            for fn in args.input
-        ),
+    inputs = (
+        ContentCsv(
+            filespec=fn, delim=args.delim, encoding=args.inputenc, stats=args.stats
+        )
+        for fn in args.input
+    )
+    write_result(args, build_cat(args, inputs))
+
+
+def build_stage(args, previous):
+    # previous is the result of the previous stage of a pipeline, or None for
+    # the first stage.
+    read = lambda fn: ContentCsv(
+        filespec=fn, delim=args.delim, encoding=args.inputenc, stats=args.stats
+    )
+    if args.subcommand in ("join", "cat"):
+        inputs = [read(fn) for fn in args.input]
+        sizes = file_sizes(args.input)
+        min_inputs = 2 if args.subcommand == "join" else 1
+        if previous is not None:
+            inputs.insert(0, previous)
+            sizes.insert(0, None)
+        elif len(inputs) < min_inputs:
+            inputs.insert(0, read(CsvFileSpec("-")))
+            sizes.insert(0, None)
+        if args.subcommand == "join":
+            return build_join(args, inputs, sizes)
+        return build_cat(args, inputs)
+
+    if previous is None:
+        if args.input is None:
+            args.input = CsvFileSpec("-")
+        previous = read(args.input)
+    if args.subcommand in ("apply", "filter") and args.added is None:
+        args.added = []
+    build = {
+        "apply": build_apply,
+        "filter": build_filter,
+        "sort": build_sort,
+        "aggregate": build_aggregate,
+        "distinct": build_distinct,
+    }[args.subcommand]
+    return build(args, previous)
+
+
+def main_pipeline(args):
+    stages = [[]]
+    for token in args.stages:
+        if token == "::":
+            stages.append([])
+        else:
+            stages[-1].append(token)
+    parser = build_parser(
+        set(stage[0] for stage in stages if stage).intersection(_PIPELINE_SUBCOMMANDS)
     )
-    write_result(args, result)
+    stages_args = []
+    for stage in stages:
+        if not stage or stage[0] not in _PIPELINE_SUBCOMMANDS:
+            parser.error(
+                "pipeline stages must be subcommands among {}".format(
+                    ", ".join(_PIPELINE_SUBCOMMANDS)
+                )
+            )
+        stage_args = parser.parse_args(stage)
+        # the default list is shared by parsings, and formats of new columns
+        # are inserted in it
+        stage_args.format = list(stage_args.format)
+        if (
+            stages_args
+            and stage_args.subcommand not in ("join", "cat")
+            and stage_args.input is not None
+        ):
+            parser.error("only the first stage of a pipeline can have an input file")
+        stages_args.append(stage_args)
+    stats = new_stats(stages_args[-1])
+    result = None
+    previous_format = None
+    for stage_args in stages_args:
+        stage_args.stats = stats
+        if previous_format is not None:
+            result = result.formatted(previous_format)
+        result = build_stage(stage_args, result)
+        previous_format = stage_args.format
+    write_result(stage_args, result)
+    write_stats(stage_args)
 
 
 def main():
     args = parseargs()
+    args.stats = new_stats(args)
 
     try:
         if args.subcommand == "join":
@@ -799,7 +1624,16 @@ def main():
             main_filter(args)
         if args.subcommand == "aggregate":
             main_aggregate(args)
+        if args.subcommand == "distinct":
+            main_distinct(args)
+        if args.subcommand == "index":
+            main_index(args)
+        if args.subcommand == "convert":
+            main_convert(args)
+        if args.subcommand == "pipeline":
+            main_pipeline(args)
         sys.stdout.flush()
+        write_stats(args)
     except BrokenPipeError:
         devnull = os.open(os.devnull, os.O_WRONLY)
         os.dup2(devnull, sys.stdout.fileno())
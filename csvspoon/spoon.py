@@ -19,12 +19,57 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import itertools
+import contextlib
+import functools
+import operator
+import keyword
+import builtins
+import array
+import codecs
+import mmap
+import ast
+import io
+import os
+import importlib
+import threading
+import queue
+import collections
+import locale
 import random
+import time
+import heapq
+import bisect
 import math
 import csv
+import stat
+import struct
 import sys
 import re
 
+_SPILL_BATCH = 1024
+_MERGE_FANIN = 64
+_WRITE_BATCH = 4096
+_OUTPUT_BUFFER = 2**20
+_PARALLEL_SORT_CHUNK = 2**18
+_GRACE_PARTITIONS = 16
+_GRACE_MAX_LEVEL = 4
+_INDEX_SUFFIX = ".spoonidx"
+_INDEX_MAGIC = b"CSVSPOONIDX1\n"
+_INDEX_SORT_BUFFER = 2**20
+_INDEX_CACHE_SIZE = 2**16
+_MMAP_BLOCK = 2**20
+_COMPRESSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "lzma", ".zst": "zstandard"}
+_DECOMPRESS_CHUNK = 2**20
+_DECOMPRESS_DEPTH = 4
+_COMPRESS_BLOCK = 2**22
+_COLUMNAR_SUFFIX = ".spoon"
+_COLUMNAR_MAGIC = b"CSVSPOONCOL2\n"
+_COLUMNAR_CHUNK = 65536
+_COLUMNAR_DICTIONARY = 2**16
+_ADAPTIVE_SAMPLE = 16
+_ADAPTIVE_PERIOD = 64
+
 
 class CsvFileSpec:
     def __init__(self, filespec):
@@ -51,10 +96,159 @@ class CsvFileSpec:
         return self._columns
 
 
+def _compression(filename):
+    # Name of the compression module of a file, from its suffix (None if the
+    # file is not compressed).
+    for suffix, module_name in _COMPRESSIONS.items():
+        if filename.endswith(suffix):
+            return module_name
+    return None
+
+
+def _compression_module(filename):
+    module_name = _compression(filename)
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        raise ImportError(
+            "Module {} is needed for {}".format(module_name, filename)
+        ) from None
+
+
+def _compress_function(filename):
+    module = _compression_module(filename)
+    if module.__name__ == "zstandard":
+        # compressors can not be shared by threads
+        return lambda data: module.ZstdCompressor().compress(data)
+    return module.compress
+
+
+class _ThreadedReader(io.RawIOBase):
+    # Reads a binary file in a background thread, so that decompression runs
+    # in parallel with parsing.
+    def __init__(self, f):
+        self._queue = queue.Queue(_DECOMPRESS_DEPTH)
+        self._buffer = memoryview(b"")
+        self._eof = False
+        self._thread = threading.Thread(target=self._run, args=(f,), daemon=True)
+        self._thread.start()
+
+    def _run(self, f):
+        try:
+            with f:
+                while True:
+                    data = f.read(_DECOMPRESS_CHUNK)
+                    self._queue.put(data)
+                    if not data:
+                        return
+        except Exception as e:
+            self._queue.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._buffer:
+            if self._eof:
+                return 0
+            data = self._queue.get()
+            if isinstance(data, Exception):
+                raise data
+            if not data:
+                self._eof = True
+                return 0
+            self._buffer = memoryview(data)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+class _BlockCompressor(io.RawIOBase):
+    # Compresses blocks in worker threads. Compressed blocks are written in
+    # order, as concatenated streams (which are read as a single one for
+    # gzip, bzip2, xz and zstd).
+    def __init__(self, f, compress, threads):
+        import concurrent.futures
+
+        self._f = f
+        self._compress = compress
+        self._threads = threads
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._written = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        if len(self._buffer) >= _COMPRESS_BLOCK:
+            self._submit()
+        return len(b)
+
+    def _submit(self):
+        self._pending.append(self._executor.submit(self._compress, bytes(self._buffer)))
+        self._buffer.clear()
+        self._written = True
+        while len(self._pending) > 2 * self._threads:
+            self._f.write(self._pending.popleft().result())
+
+    def close(self):
+        if not self.closed:
+            if self._buffer or not self._written:
+                self._submit()
+            while self._pending:
+                self._f.write(self._pending.popleft().result())
+            self._executor.shutdown()
+            self._f.close()
+        super().close()
+
+
+def _open_input(filename, encoding=None):
+    # Text file, decompressed in a background thread if compressed.
+    if _compression(filename) is None:
+        return open(filename, encoding=encoding)
+    module = _compression_module(filename)
+    if module.__name__ == "zstandard":
+        f = module.ZstdDecompressor().stream_reader(
+            open(filename, "rb"), read_across_frames=True
+        )
+    else:
+        f = module.open(filename, "rb")
+    return io.TextIOWrapper(io.BufferedReader(_ThreadedReader(f)), encoding=encoding)
+
+
+def open_output(filename, *, encoding=None, threads=1):
+    # Text file (with a large buffer), compressed if the suffix of filename is
+    # the one of a compression format (by blocks in parallel if threads > 1).
+    if _compression(filename) is None:
+        return open(filename, mode="w", encoding=encoding, buffering=_OUTPUT_BUFFER)
+    if threads > 1:
+        f = io.BufferedWriter(
+            _BlockCompressor(
+                open(filename, "wb"), _compress_function(filename), threads
+            ),
+            _OUTPUT_BUFFER,
+        )
+    else:
+        module = _compression_module(filename)
+        if module.__name__ == "zstandard":
+            f = module.ZstdCompressor().stream_writer(open(filename, "wb"))
+        else:
+            f = module.open(filename, "wb")
+    return io.TextIOWrapper(f, encoding=encoding)
+
+
 class CsvColumnsNotFound(Exception):
     pass
 
 
+def _identity(x):
+    return x
+
+
 class ColFormat:
     def __init__(self, colfmt):
         if colfmt.count(":") != 1:
@@ -65,14 +259,29 @@ class ColFormat:
         elif fmt and fmt[-1] in "eEfFgGn%":
             self._convert = float
         else:
-            self._convert = lambda x: x
+            self._convert = _identity
         self._colname = colname
         self._fmt = "{:%s}" % fmt
 
+    @property
+    def colname(self):
+        return self._colname
+
+    def format_value(self, value):
+        return self._fmt.format(self._convert(value))
+
+    def formatter(self):
+        # format_value as a single callable, without attribute lookups.
+        fmt = self._fmt.format
+        convert = self._convert
+        if convert is _identity:
+            return fmt
+        return lambda value: fmt(convert(value))
+
     def format(self, row):
         if self._colname not in row:
             raise CsvColumnsNotFound("Column {} is not found.".format(self._colname))
-        row[self._colname] = self._fmt.format(self._convert(row[self._colname]))
+        row[self._colname] = self.format_value(row[self._colname])
 
 
 class NewColFormat(ColFormat):
@@ -81,10 +290,6 @@ class NewColFormat(ColFormat):
             colfmt += ":"
         ColFormat.__init__(self, colfmt)
 
-    @property
-    def colname(self):
-        return self._colname
-
 
 class ColType:
     def __init__(self, coltype):
@@ -102,65 +307,1489 @@ class ColType:
         return (self._colname, self._type)
 
 
+class Formula:
+    def __init__(self, source, glob):
+        # leading spaces and tabs are stripped, as by eval()
+        self._source = source = source.lstrip(" \t")
+        tree = ast.parse(source, "<formula>", "eval")
+        self._names = frozenset(
+            node.id for node in ast.walk(tree) if isinstance(node, ast.Name)
+        )
+        # locals() and vars() give access to all columns, including the ones
+        # which are not identifiers
+        self._uses_locals = not self._names.isdisjoint(("locals", "vars"))
+        self._code = compile(tree, "<formula>", "eval")
+        self._glob = glob
+
+    @property
+    def source(self):
+        return self._source
+
+    @property
+    def glob(self):
+        return self._glob
+
+    @property
+    def names(self):
+        return self._names
+
+    @property
+    def uses_locals(self):
+        return self._uses_locals
+
+    def __call__(self, local):
+        return eval(self._code, self._glob, local)
+
+
+def _encode_texts(texts):
+    # Texts separated by NUL characters (as a JSON list if a text contains one).
+    joined = "\0".join(texts)
+    if joined.count("\0") == len(texts) - 1:
+        return b"\0" + joined.encode("utf8")
+    import json
+
+    return json.dumps(texts).encode("utf8")
+
+
+def _decode_texts(data):
+    if data[:1] == b"\0":
+        return str(data[1:], "utf8").split("\0")
+    import json
+
+    return json.loads(str(data, "utf8"))
+
+
+def _missing_or(typ):
+    # Conversion of typed columns of columnar files, keeping missing values
+    # (empty texts).
+    return lambda value: typ(value) if value else value
+
+
+class CsvColumnar:
+    # Columnar file: the texts of each column are stored by chunks of rows,
+    # either separated by NUL characters, or as uint16 codes in a dictionary
+    # (if it is smaller). Missing values are stored as empty texts. Types of
+    # int and float columns are checked and kept, to be converted when read.
+    # Columns are read through memory mapping.
+    _type_names = {int: "int", float: "float", str: "str"}
+
+    def __init__(self, filename, header, mm):
+        self._filename = filename
+        self._header = header
+        self._mm = mm
+        self._data = memoryview(mm)[len(_COLUMNAR_MAGIC) + 4 + header["header_size"] :]
+        self._columns = {column["name"]: column for column in header["columns"]}
+
+    @staticmethod
+    def is_columnar(filename):
+        return filename.endswith(_COLUMNAR_SUFFIX)
+
+    @classmethod
+    def write(cls, filename, content, types=None):
+        # types maps columns to int, float or str (default).
+        import json
+        import shutil
+        import tempfile
+
+        if types is None:
+            types = {}
+        for colname, typ in types.items():
+            if typ not in cls._type_names:
+                raise TypeError(
+                    "Type of column {} must be int, float or str".format(colname)
+                )
+        fieldnames = content.fieldnames
+        columns = []
+        for colname in fieldnames:
+            columns.append(
+                {
+                    "name": colname,
+                    "type": types.get(colname, str),
+                    "texts": tempfile.TemporaryFile(),
+                    "chunks": array.array("Q", [0]),
+                    "codes": tempfile.TemporaryFile(),
+                    "dictionary": {},
+                }
+            )
+        nrows = 0
+        rows = content._get_lists()
+        while True:
+            batch = list(itertools.islice(rows, _COLUMNAR_CHUNK))
+            if not batch:
+                break
+            nrows += len(batch)
+            for i, column in enumerate(columns):
+                texts = [
+                    v if type(v) is str else "" if v is None else str(v)
+                    for v in map(operator.itemgetter(i), batch)
+                ]
+                typ = column["type"]
+                if typ is not str:
+                    # raises on values which are not of the type
+                    collections.deque(map(typ, filter(None, texts)), maxlen=0)
+                data = _encode_texts(texts)
+                column["texts"].write(data)
+                column["chunks"].append(column["chunks"][-1] + len(data))
+                dictionary = column["dictionary"]
+                if dictionary is None:
+                    continue
+                for text in texts:
+                    if text not in dictionary:
+                        dictionary[text] = len(dictionary)
+                if len(dictionary) > _COLUMNAR_DICTIONARY:
+                    column["dictionary"] = None
+                    continue
+                codes = array.array("H", map(dictionary.__getitem__, texts))
+                column["codes"].write(codes.tobytes())
+
+        blobs = []
+
+        def add_blob(f):
+            size = f.seek(0, os.SEEK_END)
+            f.seek(0)
+            offset = sum(-(-s // 8) * 8 for _, s in blobs)
+            blobs.append((f, size))
+            return [offset, size]
+
+        header_columns = []
+        for column in columns:
+            header_column = {
+                "name": column["name"],
+                "type": cls._type_names[column["type"]],
+            }
+            dictionary = column["dictionary"]
+            if dictionary is not None:
+                dictionary = _encode_texts(list(dictionary))
+                texts_size = column["texts"].seek(0, os.SEEK_END)
+                texts_size += len(column["chunks"]) * column["chunks"].itemsize
+                if 2 * nrows + len(dictionary) < texts_size:
+                    header_column["codes"] = add_blob(column["codes"])
+                    header_column["dictionary"] = add_blob(io.BytesIO(dictionary))
+                    column["texts"].close()
+                    header_columns.append(header_column)
+                    continue
+            column["codes"].close()
+            header_column["texts"] = add_blob(column["texts"])
+            header_column["chunks"] = add_blob(io.BytesIO(column["chunks"].tobytes()))
+            header_columns.append(header_column)
+        header = {
+            "rows": nrows,
+            "chunk_rows": _COLUMNAR_CHUNK,
+            "columns": header_columns,
+        }
+        header = json.dumps(header).encode("utf8")
+        header += b" " * (-(len(_COLUMNAR_MAGIC) + 4 + len(header)) % 8)
+        with open(filename, "wb") as fout:
+            fout.write(_COLUMNAR_MAGIC)
+            fout.write(len(header).to_bytes(4, "little"))
+            fout.write(header)
+            for f, size in blobs:
+                shutil.copyfileobj(f, fout)
+                fout.write(b"\0" * (-size % 8))
+                f.close()
+
+    @classmethod
+    def open(cls, filename):
+        import json
+
+        with open(filename, "rb") as f:
+            if f.read(len(_COLUMNAR_MAGIC)) != _COLUMNAR_MAGIC:
+                raise ValueError("{} is not a columnar csv file".format(filename))
+            header_size = int.from_bytes(f.read(4), "little")
+            header = json.loads(f.read(header_size).decode("utf8"))
+            header["header_size"] = header_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(filename, header, mm)
+
+    @property
+    def fieldnames(self):
+        return [column["name"] for column in self._header["columns"]]
+
+    @property
+    def types(self):
+        types = {"int": int, "float": float, "str": str}
+        return {
+            column["name"]: types[column["type"]] for column in self._header["columns"]
+        }
+
+    def _blob(self, location):
+        offset, size = location
+        return self._data[offset : offset + size]
+
+    def _column_reader(self, colname):
+        # Returns a function giving the texts of the rows of a chunk.
+        column = self._columns[colname]
+        if "dictionary" in column:
+            dictionary = _decode_texts(self._blob(column["dictionary"]))
+            codes = self._blob(column["codes"]).cast("H")
+            chunk_rows = self._header["chunk_rows"]
+            return lambda i: list(
+                map(
+                    dictionary.__getitem__,
+                    codes[i * chunk_rows : (i + 1) * chunk_rows].tolist(),
+                )
+            )
+        texts = self._blob(column["texts"])
+        chunks = self._blob(column["chunks"]).cast("Q")
+        return lambda i: _decode_texts(texts[chunks[i] : chunks[i + 1]])
+
+    def rows(self, columns):
+        # Rows (as lists of texts) of the given columns.
+        readers = [self._column_reader(colname) for colname in columns]
+        nrows = self._header["rows"]
+        for i in range(-(-nrows // self._header["chunk_rows"])):
+            yield from map(list, zip(*(reader(i) for reader in readers)))
+
+
+def _positions(fieldnames):
+    return {colname: i for i, colname in enumerate(fieldnames)}
+
+
+def _tuple_getter(positions):
+    positions = tuple(positions)
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda row: (row[position],)
+    if not positions:
+        return lambda row: ()
+    return operator.itemgetter(*positions)
+
+
+def _is_bindable(colname):
+    return (
+        colname.isidentifier()
+        and not keyword.iskeyword(colname)
+        and not colname.startswith("__spoon_")
+    )
+
+
+def _fuse_pipeline(fieldnames, new_fieldnames, types, applied, filters):
+    # Generate a single function running all applies and filters on a row (a
+    # list), with columns bound as local variables and formulas inlined,
+    # instead of one eval with a locals dict per formula and per row.
+    steps = [func for _, func in applied] + list(filters)
+    if not steps or not all(isinstance(func, Formula) for func in steps):
+        return None
+    if any(func.uses_locals for func in steps):
+        return None
+    glob = steps[0].glob
+    if not all(func.glob is glob for func in steps):
+        return None
+
+    converters = []
+
+    def bind(colname, value):
+        if colname in types:
+            converters.append(types[colname])
+            return "{} = __spoon_t{}({})\n".format(colname, len(converters) - 1, value)
+        return "{} = {}\n".format(colname, value)
+
+    # Formula sources are inserted unindented inside parentheses, so that
+    # multiline formulas are kept as is. Only the columns referenced by the
+    # formulas are bound (and converted), just before the first formula using
+    # them: columns only used by a filter are not converted for rows rejected
+    # by the previous ones.
+    names = set().union(*(func.names for func in steps))
+    indent = " " * 8
+    computed_cols = set(colname for colname, _ in applied)
+    positions = _positions(tuple(fieldnames) + tuple(new_fieldnames))
+    bound = set()
+
+    def bind_used(func):
+        code = ""
+        for i, colname in enumerate(fieldnames):
+            if (
+                colname in func.names
+                and colname not in bound
+                and _is_bindable(colname)
+                and positions[colname] == i
+            ):
+                bound.add(colname)
+                if colname in computed_cols:
+                    code += indent + "{} = __spoon_row[{}]\n".format(colname, i)
+                else:
+                    code += indent + bind(colname, "__spoon_row[{}]".format(i))
+        return code
+
+    source = "    def __spoon_pipeline(__spoon_row):\n"
+    if new_fieldnames:
+        source += indent + "__spoon_row.extend({!r})\n".format(
+            (None,) * len(new_fieldnames)
+        )
+    for colname, func in applied:
+        source += bind_used(func)
+        source += indent + "__spoon_row[{}] = __spoon_v = (\n{}\n)\n".format(
+            positions[colname], func.source
+        )
+        if colname in names and _is_bindable(colname):
+            bound.add(colname)
+            source += indent + bind(colname, "__spoon_v")
+    for func in filters:
+        source += bind_used(func)
+        source += indent + "if not (\n{}\n):\n".format(func.source)
+        source += indent + "    return False\n"
+    source += indent + "return True\n"
+    source += "    return __spoon_pipeline\n"
+    source = (
+        "def __spoon_make({}):\n".format(
+            "".join("__spoon_t{}, ".format(i) for i in range(len(converters)))
+        )
+        + source
+    )
+    namespace = {}
+    exec(compile(source, "<csvspoon pipeline>", "exec"), glob, namespace)
+    return namespace["__spoon_make"](*converters)
+
+
+class _AdaptiveFilters:
+    # Filters are run in increasing order of cost / (1 - pass rate), both
+    # measured on a sample of rows, so that cheap and selective filters run
+    # first.
+    def __init__(self, filters):
+        self._filters = list(filters)
+        self._indexes = list(range(len(self._filters)))
+        self._ordered = list(self._filters)
+        self._calls = [0] * len(self._filters)
+        self._passed = [0] * len(self._filters)
+        self._time = [0.0] * len(self._filters)
+        self._count = 0
+
+    def __call__(self, row):
+        self._count += 1
+        if self._count % _ADAPTIVE_SAMPLE:
+            for func in self._ordered:
+                if not func(row):
+                    return False
+            return True
+        result = True
+        for i in self._indexes:
+            start = time.perf_counter()
+            passed = self._filters[i](row)
+            self._time[i] += time.perf_counter() - start
+            self._calls[i] += 1
+            if not passed:
+                result = False
+                break
+            self._passed[i] += 1
+        if self._count % (_ADAPTIVE_SAMPLE * _ADAPTIVE_PERIOD) == 0:
+            self._reorder()
+        return result
+
+    def _rank(self, i):
+        # Filters never reached are moved first, to be measured.
+        if not self._calls[i]:
+            return 0.0
+        rejected = 1 - self._passed[i] / self._calls[i]
+        return self._time[i] / self._calls[i] / max(rejected, 1e-9)
+
+    def _reorder(self):
+        self._indexes.sort(key=self._rank)
+        self._ordered = [self._filters[i] for i in self._indexes]
+
+
+class CsvNotSorted(Exception):
+    pass
+
+
+# Longest prefix accepted by float() (with digits grouped by underscores,
+# surrounding whitespace, inf, infinity and nan). float() does not strip the
+# ascii separators \x1c-\x1f that \s matches.
+_NUMERICAL_PREFIX = re.compile(
+    r"""
+    [^\S\x1c-\x1f]*[+-]?
+    (?:
+        inf(?:inity)?
+        |nan
+        |(?:\d(?:_?\d)*(?:\.(?:\d(?:_?\d)*)?)?|\.\d(?:_?\d)*)
+        (?:e[+-]?\d(?:_?\d)*)?
+    )
+    [^\S\x1c-\x1f]*
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+
+
+@functools.lru_cache(maxsize=2**16)
 def _cast_pseudo_numerical(value):
-    for i in range(len(value), 0, -1):
-        substr1, substr2 = value[0:i], value[i:]
-        try:
-            x = float(substr1)
-        except ValueError:
-            continue
-        return (x, substr2)
-    return (math.inf, value)
+    match = _NUMERICAL_PREFIX.match(value)
+    if match is None:
+        return (math.inf, value)
+    return (float(match.group()), value[match.end() :])
 
 
 class NotValidContent(Exception):
     pass
 
 
-def _cat_rowgen(gen1, gen2, only1, only2):
+def _spill(items):
+    import pickle
+    import tempfile
+
+    f = tempfile.TemporaryFile()
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, _SPILL_BATCH))
+        if not batch:
+            break
+        pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+
+def _unspill(f):
+    import pickle
+
+    with f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+
+class _Partitions:
+    def __init__(self, n):
+        import tempfile
+
+        self._files = [tempfile.TemporaryFile() for _ in range(n)]
+        self._batches = [[] for _ in range(n)]
+
+    def _flush(self, i):
+        import pickle
+
+        pickle.dump(self._batches[i], self._files[i], pickle.HIGHEST_PROTOCOL)
+        self._batches[i] = []
+
+    def add(self, i, item):
+        self._batches[i].append(item)
+        if len(self._batches[i]) >= _SPILL_BATCH:
+            self._flush(i)
+
+    def read(self):
+        for i, f in enumerate(self._files):
+            if self._batches[i]:
+                self._flush(i)
+            f.seek(0)
+        return [_unspill(f) for f in self._files]
+
+
+def _merge_spilled(runs, reverse):
+    get_key = operator.itemgetter(0)
+    while len(runs) > _MERGE_FANIN:
+        runs = [
+            _spill(
+                heapq.merge(
+                    *map(_unspill, runs[i : i + _MERGE_FANIN]),
+                    key=get_key,
+                    reverse=reverse
+                )
+            )
+            for i in range(0, len(runs), _MERGE_FANIN)
+        ]
+    return heapq.merge(*map(_unspill, runs), key=get_key, reverse=reverse)
+
+
+def _external_sort(keyed_items, reverse, buffer_size):
+    get_key = operator.itemgetter(0)
+    runs = []
+    keyed_items = iter(keyed_items)
+    while True:
+        chunk = list(itertools.islice(keyed_items, buffer_size))
+        if not chunk:
+            break
+        chunk.sort(key=get_key, reverse=reverse)
+        if not runs and len(chunk) < buffer_size:
+            yield from chunk
+            return
+        runs.append(_spill(chunk))
+        del chunk
+    yield from _merge_spilled(runs, reverse)
+
+
+def _sort_keys(values, numeric, random_sort, reverse):
+    # Run in a worker process: only the key values of the rows of a chunk are
+    # sent, the order of the rows (and the keys if they are not the values)
+    # are sent back.
+    keys = values
+    if numeric:
+        keys = [tuple(map(_cast_pseudo_numerical, value)) for value in keys]
+    if random_sort:
+        keys = [key + (random.random(),) for key in keys]
+    order = sorted(range(len(keys)), key=keys.__getitem__, reverse=reverse)
+    if keys is values:
+        return None, order
+    return list(map(keys.__getitem__, order)), order
+
+
+def _parallel_sorted_runs(
+    rows, key_values, numeric, random_sort, reverse, *, chunk_size, jobs
+):
+    # Yield the sorted runs (lists of (key, row)) of the chunks of rows, in
+    # the input order, so that merging them keeps the sort stable. At most
+    # jobs + 1 chunks (including the yielded run) are stored at once.
+    import multiprocessing
+
+    rows = iter(rows)
+    pending = collections.deque()
+    with multiprocessing.Pool(jobs, initializer=random.seed) as pool:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if chunk:
+                values = list(map(key_values, chunk))
+                job = (values, numeric, random_sort, reverse)
+                pending.append((chunk, values, pool.apply_async(_sort_keys, job)))
+            if pending and (not chunk or len(pending) > jobs):
+                chunk_rows, values, result = pending.popleft()
+                keys, order = result.get()
+                if keys is None:
+                    keys = map(values.__getitem__, order)
+                yield list(zip(keys, map(chunk_rows.__getitem__, order)))
+                del chunk_rows, values
+            elif not chunk:
+                return
+
+
+def record_ranges(filename, target_size, *, encoding=None):
+    # Split the records of a csv file (after the header) in byte ranges of
+    # about target_size bytes. A newline ends a record only if an even number
+    # of quote characters precedes it since the previous record end.
+    if not _is_ascii_compatible(encoding):
+        raise ValueError("Encoding {} is not ASCII compatible".format(encoding))
+    if _compression(filename) is not None:
+        raise ValueError("Compressed file {} can not be split".format(filename))
+    if not _is_regular_file(filename):
+        raise ValueError("{} is not a regular file".format(filename))
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            ranges = []
+            start = _next_record(mm, 0)
+            while start < size:
+                target = start + target_size
+                if target >= size:
+                    end = size
+                else:
+                    end = _next_record(mm, target, mm[start:target].count(b'"') & 1)
+                ranges.append((start, end))
+                start = end
+            return ranges
+
+
+def join_plan(fieldnames, sizes):
+    # Order inputs of a multiple natural inner join: the largest input is
+    # streamed (a size of None, e.g. for stdin, is considered as infinite),
+    # then the smallest input sharing a column with the already joined ones is
+    # joined (and stored in memory), and so on.
+    infinite = lambda i: (sizes[i] is None, sizes[i] or 0)
+    remaining = list(range(len(fieldnames)))
+    streamed = max(remaining, key=infinite)
+    remaining.remove(streamed)
+    order = [streamed]
+    joined_columns = set(fieldnames[streamed])
+    while remaining:
+        candidates = [
+            i for i in remaining if joined_columns.intersection(fieldnames[i])
+        ] or remaining
+        nxt = min(candidates, key=infinite)
+        remaining.remove(nxt)
+        order.append(nxt)
+        joined_columns.update(fieldnames[nxt])
+    return order
+
+
+def _parse_record(data, encoding, delim):
+    # Newlines are translated as when the file is read in text mode.
+    text = data.decode(encoding).replace("\r\n", "\n").replace("\r", "\n")
+    return next(csv.reader([text], dialect=csv.excel, delimiter=delim), [])
+
+
+def _is_ascii_compatible(encoding):
+    return '"\n'.encode(encoding or "utf8") == b'"\n'
+
+
+def _next_record(mm, pos, parity=0):
+    # A newline ends a record only if an even number of quote characters
+    # precedes it since the previous record end (parity is the parity of the
+    # number of quote characters from the previous record end to pos).
+    # Newlines are "\n", "\r\n" or "\r", as for universal newlines.
+    size = len(mm)
+    while True:
+        end = mm.find(b"\n", pos)
+        if end == -1:
+            end = size
+        cr = mm.find(b"\r", pos, end)
+        if cr != -1 and cr + 1 < end:
+            end = cr
+        if end == size:
+            return size
+        parity ^= mm[pos:end].count(b'"') & 1
+        if not parity:
+            return end + 1
+        pos = end + 1
+
+
+def _parse_block(data, encoding, delim):
+    # Rows of a block of complete records. Without quote characters, records
+    # are split without the csv module.
+    text = data.decode(encoding)
+    if "\r" in text:
+        # newlines are translated as when the file is read in text mode
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    if '"' not in text:
+        lines = filter(None, text.split("\n"))
+        return map(str.split, lines, itertools.repeat(delim))
+    return csv.reader(io.StringIO(text), dialect=csv.excel, delimiter=delim)
+
+
+def _mmap_rowgen(mm, start, end, encoding, delim):
+    pos = start
+    while pos < end:
+        target = pos + _MMAP_BLOCK
+        if target >= end:
+            stop = end
+        else:
+            stop = min(_next_record(mm, target, mm[pos:target].count(b'"') & 1), end)
+        yield from _parse_block(mm[pos:stop], encoding, delim)
+        pos = stop
+
+
+def _is_regular_file(filename):
+    # Pipes, FIFOs and devices can not be memory mapped or read twice.
+    try:
+        return stat.S_ISREG(os.stat(filename).st_mode)
+    except OSError:
+        return False
+
+
+def _mmap_reader(filename, encoding, delim, byte_range=None):
+    # Returns the header and the rows (of the byte range if given) of a file
+    # read through memory mapping, by blocks of records.
+    csv.reader((), dialect=csv.excel, delimiter=delim)  # checks delim
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return [], iter(())
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header_end = _next_record(mm, 0)
+    header = next(_parse_block(mm[:header_end], encoding, delim), [])
+    start, end = (header_end, size) if byte_range is None else byte_range
+    return header, _mmap_rowgen(mm, start, end, encoding, delim)
+
+
+def _index_hash(value):
+    import hashlib
+
+    key = "\0".join("" if v is None else v for v in value)
+    digest = hashlib.blake2b(key.encode("utf8"), digest_size=8)
+    return int.from_bytes(digest.digest(), "little")
+
+
+class CsvIndex:
+    def __init__(self, filename, header, mm, entries):
+        self._filename = filename
+        self._header = header
+        self._mm = mm
+        self._entries = entries
+        self._hashes = entries[0::2]
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                self._data = b""
+            else:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        positions = _positions(self.fieldnames)
+        self._key = _tuple_getter(positions[k] for k in self.keys)
+        # rows found for the most recently used values of keys
+        self.lookup = functools.lru_cache(maxsize=_INDEX_CACHE_SIZE)(self._lookup)
+
+    @staticmethod
+    def index_filename(filename):
+        return filename + _INDEX_SUFFIX
+
+    @classmethod
+    def build(cls, filename, keys, *, delim=",", encoding=None):
+        import json
+
+        encoding = codecs.lookup(encoding or "utf8").name
+        if not _is_ascii_compatible(encoding):
+            raise ValueError("Encoding {} is not ASCII compatible".format(encoding))
+        if _compression(filename) is not None:
+            raise ValueError("Compressed file {} can not be indexed".format(filename))
+        stat = os.stat(filename)
+        with open(filename, "rb") as f:
+            if stat.st_size == 0:
+                # an empty file can not be memory mapped, it is indexed as a
+                # file with only the key columns and no records
+                mm = contextlib.nullcontext(b"")
+            else:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with mm as mm:
+                end = _next_record(mm, 0)
+                fieldnames = _parse_record(mm[0:end], encoding, delim)
+                cols_not_found = set(keys).difference(fieldnames)
+                if cols_not_found and stat.st_size > 0:
+                    raise CsvColumnsNotFound(
+                        "Columns {} are not found in {}.".format(
+                            cols_not_found, filename
+                        )
+                    )
+
+                if stat.st_size == 0:
+                    fieldnames = list(keys)
+                positions = _positions(fieldnames)
+                positions = [positions[k] for k in keys]
+
+                def entries():
+                    start = end
+                    while start < len(mm):
+                        stop = _next_record(mm, start)
+                        row = _parse_record(mm[start:stop], encoding, delim)
+                        if row:
+                            row += [None] * (len(fieldnames) - len(row))
+                            value = tuple(row[i] for i in positions)
+                            yield ((_index_hash(value), start), None)
+                        start = stop
+
+                sorted_entries = _external_sort(
+                    entries(), reverse=False, buffer_size=_INDEX_SORT_BUFFER
+                )
+                header = json.dumps(
+                    {
+                        "size": stat.st_size,
+                        "mtime_ns": stat.st_mtime_ns,
+                        "keys": list(keys),
+                        "fieldnames": fieldnames,
+                        "delimiter": delim,
+                        "encoding": encoding,
+                    }
+                ).encode("utf8")
+                header += b" " * (-(len(_INDEX_MAGIC) + 4 + len(header)) % 8)
+                with open(cls.index_filename(filename), "wb") as fidx:
+                    fidx.write(_INDEX_MAGIC)
+                    fidx.write(len(header).to_bytes(4, "little"))
+                    fidx.write(header)
+                    while True:
+                        batch = list(itertools.islice(sorted_entries, _SPILL_BATCH))
+                        if not batch:
+                            break
+                        fidx.write(
+                            array.array(
+                                "Q", itertools.chain.from_iterable(k for k, _ in batch)
+                            ).tobytes()
+                        )
+
+    @classmethod
+    def load(cls, filename, *, delim=",", encoding=None):
+        # Returns None if there is no index for the file, or if the index is
+        # not up to date or built with another dialect.
+        import json
+
+        try:
+            fidx = open(cls.index_filename(filename), "rb")
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        with fidx:
+            if fidx.read(len(_INDEX_MAGIC)) != _INDEX_MAGIC:
+                return None
+            header_len = int.from_bytes(fidx.read(4), "little")
+            header = json.loads(fidx.read(header_len).decode("utf8"))
+            if (
+                header["size"] != stat.st_size
+                or header["mtime_ns"] != stat.st_mtime_ns
+                or header["delimiter"] != delim
+                or header["encoding"] != codecs.lookup(encoding or "utf8").name
+            ):
+                return None
+            mm = mmap.mmap(fidx.fileno(), 0, access=mmap.ACCESS_READ)
+        start = len(_INDEX_MAGIC) + 4 + header_len
+        entries = memoryview(mm)[start:].cast("Q")
+        return cls(filename, header, mm, entries)
+
+    @property
+    def keys(self):
+        return tuple(self._header["keys"])
+
+    @property
+    def fieldnames(self):
+        return tuple(self._header["fieldnames"])
+
+    def _read(self, offset):
+        row = _parse_record(
+            self._data[offset : _next_record(self._data, offset)],
+            self._header["encoding"],
+            self._header["delimiter"],
+        )
+        row += [None] * (len(self.fieldnames) - len(row))
+        del row[len(self.fieldnames) :]
+        return row
+
+    def offsets(self):
+        return sorted(self._entries[1::2])
+
+    def _lookup(self, value):
+        # Returns the offsets and rows (as lists in the order of fieldnames) of
+        # the records with the given values of keys (as a tuple, the rows
+        # being shared by lookups of the same value).
+        h = _index_hash(value)
+        hashes = self._hashes
+        found = []
+        for i in range(bisect.bisect_left(hashes, h), len(hashes)):
+            if hashes[i] != h:
+                break
+            offset = self._entries[2 * i + 1]
+            row = self._read(offset)
+            if self._key(row) == value:
+                found.append((offset, row))
+        return tuple(found)
+
+    def rows(self, offsets):
+        for offset in offsets:
+            yield offset, self._read(offset)
+
+
+def _read_rowgen(reader, positions, width):
+    # As with csv.DictReader, blank lines are skipped and missing values are
+    # None.
+    project = positions != list(range(width))
+    getter = _tuple_getter(positions)
+    for row in reader:
+        if not row:
+            continue
+        if len(row) < width:
+            row += [None] * (width - len(row))
+        if project:
+            yield list(getter(row))
+        elif len(row) > width:
+            yield row[:width]
+        else:
+            yield row
+
+
+def _cat_rowgen(gen1, gen2, padding1, getter2):
     for row in gen1:
-        row.update({k: "" for k in only2})
+        row.extend(padding1)
         yield row
     for row in gen2:
-        row.update({k: "" for k in only1})
+        yield getter2(row)
+
+
+def _formatted_lists(gen, formats):
+    for row in gen:
+        for i, format_value in formats:
+            row[i] = format_value(row[i])
         yield row
 
 
-def _join_rowgen(gen1, dict_of_oth, common, left_added_keys, added_keys, left, right):
+def _formatted_rowgen(gen, formats):
+    for row in gen:
+        for i, format_value in formats:
+            row[i] = format_value(row[i])
+        yield [
+            value if type(value) is str else "" if value is None else str(value)
+            for value in row
+        ]
+
+
+class _JoinLayout:
+    # Positions of columns in rows of joined contents.
+    def __init__(self, fieldnames, oth_fieldnames):
+        positions = _positions(fieldnames)
+        oth_positions = _positions(oth_fieldnames)
+        self.common = [k for k in fieldnames if k in oth_positions]
+        self.added_keys = [k for k in oth_fieldnames if k not in positions]
+        self.fieldnames = list(fieldnames) + self.added_keys
+        self.key = _tuple_getter(positions[k] for k in self.common)
+        self.key_oth = _tuple_getter(oth_positions[k] for k in self.common)
+        self._common_positions = [(positions[k], oth_positions[k]) for k in self.common]
+        self._added_positions = [oth_positions[k] for k in self.added_keys]
+        self._width = len(fieldnames)
+
+    def joined(self, l1, l2):
+        return l1 + [l2[j] for j in self._added_positions]
+
+    def left_only(self, l1):
+        return l1 + [""] * len(self._added_positions)
+
+    def right_only(self, l2):
+        new_line = [""] * self._width
+        for i, j in self._common_positions:
+            new_line[i] = l2[j]
+        new_line.extend(l2[j] for j in self._added_positions)
+        return new_line
+
+
+def _join_rowgen(gen1, dict_of_oth, layout, left, right):
     if right:
         not_viewed_oth = set(dict_of_oth.keys())
     for l1 in gen1:
-        value = tuple(l1[k] for k in common)
+        value = layout.key(l1)
         if value in dict_of_oth:
             if right and value in not_viewed_oth:
                 not_viewed_oth.remove(value)
             for l2 in dict_of_oth[value]:
-                new_line = l1.copy()
-                new_line.update(l2)
-                yield new_line
+                yield layout.joined(l1, l2)
         else:
             if left:
-                new_line = dict(l1)
-                new_line.update({k: "" for k in added_keys})
-                yield new_line
+                yield layout.left_only(l1)
     if right:
         for value in not_viewed_oth:
             for l2 in dict_of_oth[value]:
-                new_line = dict(l2)
-                new_line.update({k: "" for k in left_added_keys})
-                yield new_line
+                yield layout.right_only(l2)
+
+
+def _index_join_rowgen(
+    gen1, index, key, positions_in_index, layout, left, right, empty
+):
+    # key gives the values of the keys of the index in a row of the first
+    # input, positions_in_index are the positions of the columns of the joined
+    # content in the rows of the indexed file.
+    project = lambda row: [row[i] for i in positions_in_index]
+    viewed = set()
+    for l1 in gen1:
+        value = key(l1)
+        found = index.lookup(value) if empty or any(value) else ()
+        for offset, l2 in found:
+            if right:
+                viewed.add(offset)
+            yield layout.joined(l1, project(l2))
+        if not found and left:
+            yield layout.left_only(l1)
+    if right:
+        not_viewed = (offset for offset in index.offsets() if offset not in viewed)
+        for _, l2 in index.rows(not_viewed):
+            l2 = project(l2)
+            if not empty and not any(layout.key_oth(l2)):
+                continue
+            yield layout.right_only(l2)
+
+
+def _grace_join_rowgen(gen1, gen2, layout, left, right, empty, buffer_size, level=0):
+    # If the rows of the second input do not fit in the buffer, both inputs
+    # are partitioned in temporary files on the hash of common values, and
+    # partitions are joined separately (recursively).
+    dict_of_oth = {}
+    stored = 0
+    gen2 = iter(gen2)
+    for l in gen2:
+        value = layout.key_oth(l)
+        if not empty and all(not bool(x) for x in value):
+            continue
+        if value not in dict_of_oth:
+            dict_of_oth[value] = []
+        dict_of_oth[value].append(l)
+        stored += 1
+        if stored > buffer_size and level < _GRACE_MAX_LEVEL:
+            break
+    else:
+        yield from _join_rowgen(gen1, dict_of_oth, layout, left, right)
+        return
+
+    partition = lambda value: hash((level, value)) % _GRACE_PARTITIONS
+    partitions_oth = _Partitions(_GRACE_PARTITIONS)
+    for l in itertools.chain(itertools.chain.from_iterable(dict_of_oth.values()), gen2):
+        value = layout.key_oth(l)
+        if not empty and all(not bool(x) for x in value):
+            continue
+        partitions_oth.add(partition(value), l)
+    del dict_of_oth
+    partitions = _Partitions(_GRACE_PARTITIONS)
+    for l1 in gen1:
+        partitions.add(partition(layout.key(l1)), l1)
+    for rows1, rows2 in zip(partitions.read(), partitions_oth.read()):
+        yield from _grace_join_rowgen(
+            rows1, rows2, layout, left, right, empty, buffer_size, level + 1
+        )
+
+
+def _sorted_groups(rows, key, common, name):
+    previous = None
+    for value, group in itertools.groupby(rows, key=key):
+        if previous is not None and value < previous:
+            raise CsvNotSorted(
+                "{} input is not sorted on {} ({!r} found after {!r}).".format(
+                    name, ", ".join(common), value, previous
+                )
+            )
+        previous = value
+        yield value, list(group)
+
+
+def _comparable_key(key):
+    # Missing values (of short rows) are compared as empty values.
+    def comparable(row):
+        value = key(row)
+        if None in value:
+            return tuple("" if x is None else x for x in value)
+        return value
+
+    return comparable
+
+
+def _merge_join_rowgen(gen1, gen2, layout, left, right, empty):
+    # Both inputs are sorted on common columns, only the rows of the second
+    # input with the current key are stored.
+    key = _comparable_key(layout.key)
+    key_oth = _comparable_key(layout.key_oth)
+    groups_oth = _sorted_groups(gen2, key_oth, layout.common, "Right")
+    value_oth, rows_oth = next(groups_oth, (None, None))
+    viewed = False
+    for value, rows in _sorted_groups(gen1, key, layout.common, "Left"):
+        while rows_oth is not None and value_oth < value:
+            if right and not viewed and (empty or any(value_oth)):
+                yield from map(layout.right_only, rows_oth)
+            value_oth, rows_oth = next(groups_oth, (None, None))
+            viewed = False
+        matched = rows_oth is not None and value_oth == value and (empty or any(value))
+        for l1 in rows:
+            if matched:
+                for l2 in rows_oth:
+                    yield layout.joined(l1, l2)
+            elif left:
+                yield layout.left_only(l1)
+        viewed = viewed or matched
+    while rows_oth is not None:
+        if right and not viewed and (empty or any(value_oth)):
+            yield from map(layout.right_only, rows_oth)
+        value_oth, rows_oth = next(groups_oth, (None, None))
+        viewed = False
+
+
+def _distinct_rowgen(rows, key, buffer_size, level=0):
+    # First occurrences are yielded as soon as they are read. If there are
+    # more than buffer_size distinct keys, the remaining rows with a key not
+    # seen yet are partitioned in temporary files on the hash of the key, and
+    # partitions are processed separately (recursively).
+    seen = set()
+    rows = iter(rows)
+    for row in rows:
+        value = key(row)
+        if value not in seen:
+            seen.add(value)
+            yield row
+            if (
+                buffer_size is not None
+                and len(seen) >= buffer_size
+                and level < _GRACE_MAX_LEVEL
+            ):
+                break
+    else:
+        return
+
+    partition = lambda value: hash((level, value)) % _GRACE_PARTITIONS
+    partitions = _Partitions(_GRACE_PARTITIONS)
+    for row in rows:
+        value = key(row)
+        if value not in seen:
+            partitions.add(partition(value), row)
+    del seen
+    for part in partitions.read():
+        yield from _distinct_rowgen(part, key, buffer_size, level + 1)
+
+
+def count(values):
+    return len(values)
+
+
+def mean(values):
+    return sum(values) / len(values)
+
+
+def variance(values):
+    m = mean(values)
+    return sum((value - m) ** 2 for value in values) / len(values)
+
+
+def first(values):
+    return values[0]
+
+
+def last(values):
+    return values[-1]
+
+
+AGGREGATION_FUNCTIONS = {
+    "count": count,
+    "mean": mean,
+    "variance": variance,
+    "first": first,
+    "last": last,
+}
+
+
+class _CountAccumulator:
+    __slots__ = ("_n",)
+
+    def __init__(self):
+        self._n = 0
+
+    def update(self, value):
+        self._n += 1
+
+    def result(self):
+        return self._n
+
+
+# Bounds of the C long, used by the fast paths of builtin sum()
+_LONG_MAX = 2 ** (8 * struct.calcsize("l") - 1) - 1
+_LONG_MIN = -_LONG_MAX - 1
+# builtin sum() adds floats with a compensated (Neumaier) summation
+_COMPENSATED_SUM = sys.version_info >= (3, 12)
+
+
+class _SumAccumulator:
+    # Same result as builtin sum() on the values, following its paths: ints
+    # are added while the total fits in a C long, then if the total is a
+    # float, floats (and ints fitting in a C long) are added in a float
+    # (compensated since python 3.12), else values are added generically.
+    __slots__ = ("_total", "_compensation", "_mode")
+
+    def __init__(self):
+        self._total = 0
+        self._compensation = 0.0
+        self._mode = 0  # 0: int, 1: float, 2: generic
+
+    def update(self, value):
+        mode = self._mode
+        total = self._total
+        if mode == 1:
+            if type(value) is float:
+                new = total + value
+                if _COMPENSATED_SUM:
+                    if abs(total) >= abs(value):
+                        self._compensation += (total - new) + value
+                    else:
+                        self._compensation += (value - new) + total
+                self._total = new
+                return
+            if isinstance(value, int) and _LONG_MIN <= value <= _LONG_MAX:
+                self._total = total + float(value)
+                return
+            total = self._float_total()
+            self._mode = 2
+        elif mode == 0:
+            if (
+                (type(value) is int or type(value) is bool)
+                and _LONG_MIN <= value <= _LONG_MAX
+                and _LONG_MIN <= total + value <= _LONG_MAX
+            ):
+                self._total = total + value
+                return
+            total = self._total = total + value
+            self._mode = 1 if type(total) is float else 2
+            return
+        self._total = total + value
+
+    def _float_total(self):
+        compensation = self._compensation
+        if compensation and math.isfinite(compensation):
+            return self._total + compensation
+        return self._total
+
+    def result(self):
+        if self._mode == 1:
+            return self._float_total()
+        return self._total
+
+
+class _MinAccumulator:
+    __slots__ = ("_value", "_empty")
+
+    def __init__(self):
+        self._empty = True
+
+    def update(self, value):
+        if self._empty or value < self._value:
+            self._value = value
+            self._empty = False
+
+    def result(self):
+        return self._value
+
+
+class _MaxAccumulator:
+    __slots__ = ("_value", "_empty")
+
+    def __init__(self):
+        self._empty = True
+
+    def update(self, value):
+        if self._empty or value > self._value:
+            self._value = value
+            self._empty = False
+
+    def result(self):
+        return self._value
+
+
+class _MeanAccumulator(_SumAccumulator):
+    __slots__ = ("_n",)
+
+    def __init__(self):
+        super().__init__()
+        self._n = 0
+
+    def update(self, value):
+        super().update(value)
+        self._n += 1
+
+    def result(self):
+        return super().result() / self._n
+
+
+class _VarianceAccumulator:
+    # Welford's online algorithm
+    __slots__ = ("_n", "_mean", "_m2")
+
+    def __init__(self):
+        self._n = 0
+        self._mean = 0
+        self._m2 = 0
+
+    def update(self, value):
+        self._n += 1
+        delta = value - self._mean
+        self._mean += delta / self._n
+        self._m2 += delta * (value - self._mean)
+
+    def result(self):
+        return self._m2 / self._n
+
+
+class _FirstAccumulator:
+    __slots__ = ("_value", "_empty")
+
+    def __init__(self):
+        self._empty = True
+
+    def update(self, value):
+        if self._empty:
+            self._value = value
+            self._empty = False
+
+    def result(self):
+        return self._value
+
+
+class _LastAccumulator:
+    __slots__ = ("_value",)
+
+    def update(self, value):
+        self._value = value
+
+    def result(self):
+        return self._value
+
+
+_ACCUMULATORS = {
+    len: _CountAccumulator,
+    sum: _SumAccumulator,
+    min: _MinAccumulator,
+    max: _MaxAccumulator,
+    count: _CountAccumulator,
+    mean: _MeanAccumulator,
+    variance: _VarianceAccumulator,
+    first: _FirstAccumulator,
+    last: _LastAccumulator,
+}
+
+
+class _AccumulatorRewriter(ast.NodeTransformer):
+    # Calls of known aggregation functions on a single column are replaced by
+    # the result of an accumulator. The aggregation can be streamed if no other
+    # reference to a column remains.
+    def __init__(self, glob, fieldnames):
+        self._glob = glob
+        self._fieldnames = fieldnames
+        self.accumulators = []
+        self.streamable = True
+
+    def _accumulator_of(self, node):
+        if not isinstance(node.func, ast.Name) or node.keywords:
+            return None
+        if len(node.args) != 1 or not isinstance(node.args[0], ast.Name):
+            return None
+        if node.args[0].id not in self._fieldnames:
+            return None
+        if node.func.id in self._fieldnames:
+            return None
+        func = self._glob.get(node.func.id, getattr(builtins, node.func.id, None))
+        try:
+            return _ACCUMULATORS.get(func)
+        except TypeError:
+            return None
+
+    def visit_Call(self, node):
+        accumulator = self._accumulator_of(node)
+        if accumulator is None:
+            return self.generic_visit(node)
+        name = "__spoon_acc{}".format(len(self.accumulators))
+        self.accumulators.append((node.args[0].id, accumulator))
+        return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+
+    def visit_Name(self, node):
+        if node.id in self._fieldnames:
+            self.streamable = False
+        return node
 
 
-def _aggregate_row_gen(new_fieldnames, stored_by_key_data_column, aggregation):
-    fields_aggregation = set(colname for colname, _ in aggregation)
-    for store in stored_by_key_data_column.values():
-        row = {
-            colname: store[colname][0]
+class _StreamedAggregation:
+    def __init__(self, formula, fieldnames):
+        rewriter = _AccumulatorRewriter(formula.glob, fieldnames)
+        tree = rewriter.visit(ast.parse(formula.source, "<formula>", "eval"))
+        self._code = compile(ast.fix_missing_locations(tree), "<formula>", "eval")
+        self._glob = formula.glob
+        self.streamable = rewriter.streamable
+        self.columns = [colname for colname, _ in rewriter.accumulators]
+        self._accumulators = [acc for _, acc in rewriter.accumulators]
+
+    def new_accumulators(self):
+        return [acc() for acc in self._accumulators]
+
+    def result(self, accumulators):
+        return eval(
+            self._code,
+            self._glob,
+            {
+                "__spoon_acc{}".format(i): accumulator.result()
+                for i, accumulator in enumerate(accumulators)
+            },
+        )
+
+
+def _aggregate_row_gen(
+    new_fieldnames, positions, groups, aggregations, streamed_aggregations
+):
+    for first_row, _, accumulators, store in groups.values():
+        values = {}
+        for (colname, func), streamed, accs in zip(
+            aggregations, streamed_aggregations, accumulators
+        ):
+            if streamed is not None:
+                values[colname] = streamed.result(accs)
+            else:
+                values[colname] = func(store)
+        yield [
+            values[colname] if colname in values else first_row[positions[colname]]
             for colname in new_fieldnames
-            if colname not in fields_aggregation
+        ]
+
+
+class _Stage:
+    __slots__ = ("name", "rows_in", "rows_out", "seconds", "entries")
+
+    def __init__(self, name):
+        self.name = name
+        self.rows_in = 0
+        self.rows_out = 0
+        self.seconds = 0.0
+        self.entries = None
+
+
+class Stats:
+    # Rows and time of the stages of the processing of contents. Times are
+    # exclusive: the time spent in a stage does not include the time spent
+    # in the stages giving its input rows.
+    def __init__(self, *, trace_memory=False):
+        self._stages = []
+        self._names = collections.Counter()
+        self._measured = 0.0
+        self._trace_memory = trace_memory
+        if trace_memory:
+            import tracemalloc
+
+            tracemalloc.start()
+        self._start = time.perf_counter()
+
+    def stage(self, name):
+        self._names[name] += 1
+        if self._names[name] > 1:
+            name = "{} #{}".format(name, self._names[name])
+        stage = _Stage(name)
+        self._stages.append(stage)
+        return stage
+
+    def count(self, stage, rows):
+        for row in rows:
+            stage.rows_in += 1
+            yield row
+
+    def rows(self, stage, rows):
+        clock = time.perf_counter
+        rows = iter(rows)
+        end = object()
+        while True:
+            measured = self._measured
+            start = clock()
+            row = next(rows, end)
+            elapsed = clock() - start - (self._measured - measured)
+            stage.seconds += elapsed
+            self._measured += elapsed
+            if row is end:
+                return
+            stage.rows_out += 1
+            yield row
+
+    def add_time(self, stage, seconds):
+        stage.seconds += seconds
+        self._measured += seconds
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        measured = self._measured
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            self.add_time(
+                stage, time.perf_counter() - start - (self._measured - measured)
+            )
+
+    def summary(self):
+        summary = {
+            "seconds": time.perf_counter() - self._start,
+            "stages": [
+                {key: getattr(stage, key) for key in _Stage.__slots__}
+                for stage in self._stages
+            ],
         }
-        row.update({colname: func(store) for colname, func in aggregation})
-        yield row
+        try:
+            import resource
+        except ImportError:
+            pass
+        else:
+            # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+            unit = 1 if sys.platform == "darwin" else 1024
+            summary["peak_rss"] = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+            )
+        if self._trace_memory:
+            import tracemalloc
+
+            summary["tracemalloc_peak"] = tracemalloc.get_traced_memory()[1]
+        return summary
+
+    def write(self, f):
+        summary = self.summary()
+        f.write(
+            "{:<24} {:>12} {:>12} {:>10} {:>10}\n".format(
+                "stage", "rows in", "rows out", "seconds", "entries"
+            )
+        )
+        for stage in summary["stages"]:
+            entries = stage["entries"]
+            f.write(
+                "{name:<24} {rows_in:>12} {rows_out:>12} {seconds:>10.3f}".format(
+                    **stage
+                )
+                + " {:>10}\n".format("" if entries is None else entries)
+            )
+        f.write("{:<50} {:>10.3f}\n".format("total", summary["seconds"]))
+        for key in ("peak_rss", "tracemalloc_peak"):
+            if key in summary:
+                f.write("{:<50} {:>10}\n".format(key, summary[key]))
 
 
 class ContentCsv:
@@ -170,30 +1799,62 @@ class ContentCsv:
         filespec: CsvFileSpec = None,
         delim=",",
         encoding=None,
+        stats=None,
         _fieldnames=None,
-        _rows=None
+        _rows=None,
+        _byte_range=None
     ):
+        self._stats = stats
         self._applied = []
         self._types = {}
         self._new_fieldnames = []
         self._filters = []
+        self._adaptive = False
+        self._filespec = filespec
+        self._delim = delim
+        self._encoding = encoding
         if filespec is not None:
-            dialect = csv.excel
-            dialect.delimiter = delim
-            if filespec.filename == "-":
-                f = sys.stdin
+            file_encoding = encoding or locale.getpreferredencoding(False)
+            if CsvColumnar.is_columnar(filespec.filename):
+                columnar = CsvColumnar.open(filespec.filename)
+                fieldnames = columnar.fieldnames
+            elif (
+                filespec.filename != "-"
+                and _compression(filespec.filename) is None
+                and _is_ascii_compatible(file_encoding)
+                and _is_regular_file(filespec.filename)
+            ):
+                fieldnames, reader = _mmap_reader(
+                    filespec.filename, file_encoding, delim, _byte_range
+                )
             else:
-                f = open(filespec.filename, encoding=encoding)
-            reader = csv.DictReader(f, dialect=dialect)
+                dialect = csv.excel
+                dialect.delimiter = delim
+                if filespec.filename == "-":
+                    f = sys.stdin
+                else:
+                    f = _open_input(filespec.filename, encoding=encoding)
+                reader = csv.reader(f, dialect=dialect)
+                fieldnames = next(reader, [])
+                if _byte_range is not None:
+                    # for internal use only, rows of the byte range (given by
+                    # record_ranges) are read, using the header of the file
+                    start, end = _byte_range
+                    f.close()
+                    with open(filespec.filename, "rb") as fbin:
+                        fbin.seek(start)
+                        data = fbin.read(end - start)
+                    f = io.TextIOWrapper(io.BytesIO(data), encoding=encoding)
+                    reader = csv.reader(f, dialect=dialect)
             if filespec.columns is None:
-                self._fieldnames = reader.fieldnames
+                self._fieldnames = fieldnames
                 fieldnames_map = {k: k for k in self._fieldnames}
             else:
                 old_col_name = lambda col: col.split("=")[1] if "=" in col else col
                 new_col_name = lambda col: col.split("=")[0] if "=" in col else col
                 cols_not_found = set(
                     old_col_name(col) for col in filespec.columns
-                ).difference(reader.fieldnames)
+                ).difference(fieldnames)
                 if cols_not_found:
                     raise CsvColumnsNotFound(
                         "Columns {} are not found in {}.".format(
@@ -204,14 +1865,40 @@ class ContentCsv:
                 fieldnames_map = {
                     new_col_name(col): old_col_name(col) for col in filespec.columns
                 }
-            self._rows = (
-                {c: row[fieldnames_map[c]] for c in self._fieldnames} for row in reader
-            )
+            self._fieldnames_map = fieldnames_map
+            stage = None
+            if stats is not None:
+                # rows in are the records read, rows out the rows (without
+                # blank lines)
+                stage = stats.stage("read {}".format(filespec.filename))
+            if CsvColumnar.is_columnar(filespec.filename):
+                # only the used columns are read, typed columns being
+                # converted as with --type (except missing values)
+                self._rows = columnar.rows(
+                    [fieldnames_map[c] for c in self._fieldnames]
+                )
+                if stage is not None:
+                    self._rows = stats.count(stage, self._rows)
+                types = columnar.types
+                for c in self._fieldnames:
+                    if types[fieldnames_map[c]] is not str:
+                        self._types[c] = _missing_or(types[fieldnames_map[c]])
+            else:
+                if stage is not None:
+                    reader = stats.count(stage, reader)
+                positions = _positions(fieldnames)
+                self._rows = _read_rowgen(
+                    reader,
+                    [positions[fieldnames_map[c]] for c in self._fieldnames],
+                    len(fieldnames),
+                )
+            if stage is not None:
+                self._rows = stats.rows(stage, self._rows)
             self._valid = True
         else:
             if _fieldnames is None or _rows is None:
                 raise TypeError("{} need filespec".format(self.__class__.__name__))
-            # for internal use only
+            # for internal use only, rows are lists of values of columns
             self._rows = _rows
             self._fieldnames = _fieldnames
             self._valid = True
@@ -229,38 +1916,120 @@ class ContentCsv:
         return self._get_rows(typed=True)
 
     def _get_rows(self, typed=False):
+        fieldnames = self.fieldnames
+        for row in self._get_lists(typed):
+            yield dict(zip(fieldnames, row))
+
+    def _get_lists(self, typed=False):
+        # Rows as lists of values, in the order of fieldnames.
         if not self._valid:
             raise NotValidContent
         self._valid = False
+        types = self._types
+        if not (self._applied or self._filters or typed):
+            yield from self._rows
+            return
+        if self._stats is not None:
+            # The evaluation actually used (fused or generic) is
+            # measured as a whole.
+            stats = self._stats
+            stage = stats.stage(
+                "formulas" if self._applied or self._filters else "convert"
+            )
+            rows = self._evaluated_lists(stats.count(stage, self._rows), typed, types)
+            yield from stats.rows(stage, rows)
+            return
+        yield from self._evaluated_lists(self._rows, typed, types)
+
+    def _evaluated_lists(self, rows, typed, types):
+        adaptive = self._adaptive and len(self._filters) > 1
+        if not typed and adaptive:
+            # Applies are fused, and each filter is fused separately to be
+            # reordered.
+            pipeline = _fuse_pipeline(
+                self._fieldnames,
+                self._new_fieldnames,
+                types,
+                self._applied,
+                (),
+            )
+            filters = [
+                _fuse_pipeline(self.fieldnames, (), types, (), (func,))
+                for func in self._filters
+            ]
+            if (pipeline is not None or not self._applied) and None not in filters:
+                filters = _AdaptiveFilters(filters)
+                for row in rows:
+                    if pipeline is not None:
+                        pipeline(row)
+                    if filters(row):
+                        yield row
+                return
+        elif not typed:
+            pipeline = _fuse_pipeline(
+                self._fieldnames,
+                self._new_fieldnames,
+                types,
+                self._applied,
+                self._filters,
+            )
+            if pipeline is not None:
+                for row in rows:
+                    if pipeline(row):
+                        yield row
+                return
+        fieldnames = self.fieldnames
+        positions = _positions(fieldnames)
+        padding = [None] * len(self._new_fieldnames)
         computed_cols = set(colname for colname, _ in self._applied)
-        for row in self._rows:
-            if self._applied or self._filters or typed:
-                typed_row = row.copy()
-                typed_row.update(
-                    {
-                        c: t(row[c])
-                        for c, t in self._types.items()
-                        if c not in computed_cols
-                    }
-                )
+        filters = self._filters
+        if adaptive:
+            filters = [_AdaptiveFilters(filters)]
+        for row in rows:
+            typed_row = dict(zip(self._fieldnames, row))
+            typed_row.update(
+                {c: t(typed_row[c]) for c, t in types.items() if c not in computed_cols}
+            )
+            row.extend(padding)
             for colname, func in self._applied:
-                row[colname] = func(typed_row)
-                if colname in self._types:
-                    typed_row[colname] = self._types[colname](row[colname])
+                value = row[positions[colname]] = func(typed_row)
+                if colname in types:
+                    typed_row[colname] = types[colname](value)
                 else:
-                    typed_row[colname] = row[colname]
+                    typed_row[colname] = value
             filter_ok = True
-            for func in self._filters:
+            for func in filters:
                 if not func(typed_row):
                     filter_ok = False
+                    break
             if filter_ok:
                 if typed:
-                    yield typed_row
+                    yield [typed_row[c] for c in fieldnames]
                 else:
                     yield row
 
+    def _stage(self, name):
+        if self._stats is None:
+            return None
+        return self._stats.stage(name)
+
+    def _lists_in(self, stage, typed=False):
+        if stage is None:
+            return self._get_lists(typed)
+        return self._stats.count(stage, self._get_lists(typed))
+
+    def _rows_out(self, stage, rows):
+        if stage is None:
+            return rows
+        return self._stats.rows(stage, rows)
+
+    def _measure(self, stage):
+        if stage is None:
+            return contextlib.nullcontext()
+        return self._stats.measure(stage)
+
     def add_apply(self, colname, func):
-        if colname not in self._fieldnames:
+        if colname not in self.fieldnames:
             self._new_fieldnames.append(colname)
         self._applied.append((colname, func))
 
@@ -270,35 +2039,160 @@ class ContentCsv:
     def add_type(self, colname, typ):
         self._types[colname] = typ
 
-    def join(self, oth, *, left=False, right=False, empty=False):
-        common = set(self.fieldnames).intersection(set(oth.fieldnames))
+    def set_adaptive(self, adaptive=True):
+        self._adaptive = adaptive
+
+    def select(self, columns):
+        positions = _positions(self.fieldnames)
+        cols_not_found = set(columns).difference(positions)
+        if cols_not_found:
+            raise CsvColumnsNotFound("Columns {} are not found.".format(cols_not_found))
+        getter = [positions[colname] for colname in columns]
+        return ContentCsv(
+            stats=self._stats,
+            _fieldnames=list(columns),
+            _rows=([row[i] for i in getter] for row in self._get_lists()),
+        )
+
+    def join(
+        self,
+        oth,
+        *,
+        left=False,
+        right=False,
+        empty=False,
+        sorted_input=False,
+        buffer_size=None,
+        use_index=False
+    ):
+        layout = _JoinLayout(self.fieldnames, oth.fieldnames)
+        if sorted_input:
+            stage = self._stage("join")
+            return ContentCsv(
+                stats=self._stats,
+                _fieldnames=layout.fieldnames,
+                _rows=self._rows_out(
+                    stage,
+                    _merge_join_rowgen(
+                        self._lists_in(stage),
+                        oth._lists_in(stage),
+                        layout,
+                        left,
+                        right,
+                        empty,
+                    ),
+                ),
+            )
+        index = oth._index(layout.common) if use_index else None
+        if index is not None:
+            oth._valid = False
+            index_positions = _positions(index.fieldnames)
+            common_of_key = {oth._fieldnames_map[k]: k for k in layout.common}
+            positions = _positions(self.fieldnames)
+            stage = self._stage("index join")
+            return ContentCsv(
+                stats=self._stats,
+                _fieldnames=layout.fieldnames,
+                _rows=self._rows_out(
+                    stage,
+                    _index_join_rowgen(
+                        self._lists_in(stage),
+                        index,
+                        _tuple_getter(positions[common_of_key[k]] for k in index.keys),
+                        [
+                            index_positions[oth._fieldnames_map[k]]
+                            for k in oth.fieldnames
+                        ],
+                        layout,
+                        left,
+                        right,
+                        empty,
+                    ),
+                ),
+            )
+        if buffer_size is not None:
+            if buffer_size < 1:
+                raise ValueError("buffer_size must be a positive number of rows")
+            stage = self._stage("grace join")
+            return ContentCsv(
+                stats=self._stats,
+                _fieldnames=layout.fieldnames,
+                _rows=self._rows_out(
+                    stage,
+                    _grace_join_rowgen(
+                        self._lists_in(stage),
+                        oth._lists_in(stage),
+                        layout,
+                        left,
+                        right,
+                        empty,
+                        buffer_size,
+                    ),
+                ),
+            )
+        build = self._stage("join build")
         dict_of_oth = {}
-        for l in oth.rows:
-            value = tuple(l[k] for k in common)
-            if not empty and all(not bool(x) for x in value):
-                continue
-            if value not in dict_of_oth:
-                dict_of_oth[value] = []
-            dict_of_oth[value].append(l)
-        left_added_keys = [k for k in self.fieldnames if k not in common]
-        added_keys = [k for k in oth.fieldnames if k not in common]
-        new_fieldnames = list(self.fieldnames) + added_keys
+        with self._measure(build):
+            for l in oth._lists_in(build):
+                value = layout.key_oth(l)
+                if not empty and all(not bool(x) for x in value):
+                    continue
+                if value not in dict_of_oth:
+                    dict_of_oth[value] = []
+                dict_of_oth[value].append(l)
+        if build is not None:
+            # rows with empty values of common columns are not stored
+            build.rows_out = sum(map(len, dict_of_oth.values()))
+            build.entries = len(dict_of_oth)
+        probe = self._stage("join probe")
         return ContentCsv(
-            _fieldnames=new_fieldnames,
-            _rows=_join_rowgen(
-                self.rows, dict_of_oth, common, left_added_keys, added_keys, left, right
+            stats=self._stats,
+            _fieldnames=layout.fieldnames,
+            _rows=self._rows_out(
+                probe,
+                _join_rowgen(self._lists_in(probe), dict_of_oth, layout, left, right),
             ),
         )
 
+    def _index(self, common):
+        # Up to date index usable to join on common columns, if any.
+        if (
+            self._filespec is None
+            or self._filespec.filename == "-"
+            or self._applied
+            or self._filters
+            or not self._valid
+        ):
+            return None
+        index = CsvIndex.load(
+            self._filespec.filename, delim=self._delim, encoding=self._encoding
+        )
+        if index is None:
+            return None
+        if set(index.keys) != set(self._fieldnames_map[k] for k in common):
+            return None
+        return index
+
     def concat(self, oth):
-        only_self = set(self.fieldnames).difference(set(oth.fieldnames))
         only_oth = set(oth.fieldnames).difference(set(self.fieldnames))
         new_fieldnames = list(self.fieldnames) + [
             k for k in oth.fieldnames if k in only_oth
         ]
+        oth_positions = _positions(oth.fieldnames)
+        getter = [oth_positions.get(k) for k in new_fieldnames]
+        stage = self._stage("cat")
         return ContentCsv(
+            stats=self._stats,
             _fieldnames=new_fieldnames,
-            _rows=_cat_rowgen(self.rows, oth.rows, only_self, only_oth),
+            _rows=self._rows_out(
+                stage,
+                _cat_rowgen(
+                    self._lists_in(stage),
+                    oth._lists_in(stage),
+                    [""] * (len(new_fieldnames) - len(self.fieldnames)),
+                    lambda row: ["" if i is None else row[i] for i in getter],
+                ),
+            ),
         )
 
     def aggregate(self, keys, aggregations):
@@ -306,62 +2200,238 @@ class ContentCsv:
             aggregations = ()
         if keys is None:
             keys = ()
+        fieldnames = self.fieldnames
+        positions = _positions(fieldnames)
+        key = _tuple_getter(positions[k] for k in keys)
 
-        stored_by_key_data_column = {}
-        for row in self._get_rows(typed=True):
-            keyvalue = tuple(row[k] for k in keys)
-            if keyvalue not in stored_by_key_data_column:
-                store = {colname: [] for colname in self.fieldnames}
-                stored_by_key_data_column[keyvalue] = store
+        # Aggregations which can be computed by accumulators are streamed.
+        # Lists of values are only stored for the columns used by the other
+        # ones (all columns for aggregations which are not Formula).
+        streamed_aggregations = []
+        stored_columns = set()
+        for _, func in aggregations:
+            streamed = None
+            if isinstance(func, Formula) and not func.uses_locals:
+                streamed = _StreamedAggregation(func, fieldnames)
+                if not streamed.streamable:
+                    streamed = None
+                    stored_columns.update(func.names.intersection(fieldnames))
             else:
-                store = stored_by_key_data_column[keyvalue]
-            for colname, value in row.items():
-                store[colname].append(value)
+                stored_columns.update(fieldnames)
+            streamed_aggregations.append(streamed)
+        stored_columns = [
+            (colname, positions[colname])
+            for colname in fieldnames
+            if colname in stored_columns
+        ]
+        streamed_positions = [
+            [positions[colname] for colname in streamed.columns]
+            if streamed is not None
+            else None
+            for streamed in streamed_aggregations
+        ]
+
+        # For each group, are stored the first row, the set of positions of
+        # non constant columns, the accumulators and the lists of values.
+        groups = {}
+        stage = self._stage("aggregate")
+        with self._measure(stage):
+            for row in self._lists_in(stage, typed=True):
+                keyvalue = key(row)
+                if keyvalue not in groups:
+                    accumulators = [
+                        streamed.new_accumulators() if streamed is not None else None
+                        for streamed in streamed_aggregations
+                    ]
+                    store = {colname: [] for colname, _ in stored_columns}
+                    groups[keyvalue] = (row, set(), accumulators, store)
+                else:
+                    first_row, not_constant, accumulators, store = groups[keyvalue]
+                    for i, value in enumerate(row):
+                        if i not in not_constant and value != first_row[i]:
+                            not_constant.add(i)
+                for accs, acc_positions in zip(accumulators, streamed_positions):
+                    if accs is not None:
+                        for acc, i in zip(accs, acc_positions):
+                            acc.update(row[i])
+                for colname, i in stored_columns:
+                    store[colname].append(row[i])
+        if stage is not None:
+            stage.entries = len(groups)
+        not_constant = set().union(*(group[1] for group in groups.values()))
+        not_constant = set(fieldnames[i] for i in not_constant)
         new_fieldnames = [
-            colname
-            for colname in self.fieldnames
-            if all(
-                len(set(store[colname])) == 1
-                for store in stored_by_key_data_column.values()
-            )
+            colname for colname in fieldnames if colname not in not_constant
         ]
         new_fieldnames.extend(
             colname for colname, _ in aggregations if colname not in new_fieldnames
         )
         return ContentCsv(
+            stats=self._stats,
             _fieldnames=new_fieldnames,
-            _rows=_aggregate_row_gen(
-                new_fieldnames, stored_by_key_data_column, aggregations
+            _rows=self._rows_out(
+                stage,
+                _aggregate_row_gen(
+                    new_fieldnames,
+                    positions,
+                    groups,
+                    aggregations,
+                    streamed_aggregations,
+                ),
+            ),
+        )
+
+    def distinct(self, keys=None, buffer_size=None):
+        positions = _positions(self.fieldnames)
+        if keys:
+            cols_not_found = set(keys).difference(positions)
+            if cols_not_found:
+                raise CsvColumnsNotFound(
+                    "Columns {} are not found.".format(cols_not_found)
+                )
+            key = _tuple_getter(positions[k] for k in keys)
+        else:
+            key = tuple
+        if buffer_size is not None and buffer_size < 1:
+            raise ValueError("buffer_size must be a positive number of keys")
+
+        # Without buffer_size, or until buffer_size keys are seen, the order
+        # of rows is kept.
+        stage = self._stage("distinct")
+        return ContentCsv(
+            stats=self._stats,
+            _fieldnames=self.fieldnames,
+            _rows=self._rows_out(
+                stage, _distinct_rowgen(self._lists_in(stage), key, buffer_size)
             ),
         )
 
-    def sort(self, keys=tuple(), numeric=False, reverse=False, random_sort=False):
+    def sort(
+        self,
+        keys=tuple(),
+        numeric=False,
+        reverse=False,
+        random_sort=False,
+        buffer_size=None,
+        limit=None,
+        jobs=1,
+    ):
         if keys is None:
             keys = ()
+        positions = _positions(self.fieldnames)
+        key_values = _tuple_getter(positions[k] for k in keys)
         if numeric:
-            cast_numeric = _cast_pseudo_numerical
+            key_fun = lambda row: tuple(map(_cast_pseudo_numerical, key_values(row)))
         else:
-            cast_numeric = lambda x: x
+            key_fun = key_values
 
         if random_sort:
-            append_random = lambda t: t + (random.random(),)
-        else:
-            append_random = lambda t: t
+            key_fun_random = key_fun
+            key_fun = lambda row: key_fun_random(row) + (random.random(),)
+
+        # the sort (or the sort of the runs) is done here, except for the
+        # merge of runs
+        stage = self._stage("sort")
+        with self._measure(stage):
+            if limit is not None:
+                if limit < 0:
+                    raise ValueError("limit must be a non negative number of rows")
+                # as sorted()[:limit], keeping only limit rows in a heap
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                sorted_rows = (
+                    row for row in select(limit, self._lists_in(stage), key=key_fun)
+                )
+            elif jobs > 1:
+                if buffer_size is not None and buffer_size < 1:
+                    raise ValueError("buffer_size must be a positive number of rows")
+                # at most jobs + 1 chunks of rows are stored at once
+                if buffer_size is None:
+                    chunk_size = _PARALLEL_SORT_CHUNK
+                else:
+                    chunk_size = max(buffer_size // (jobs + 1), 1)
+                runs = _parallel_sorted_runs(
+                    self._lists_in(stage),
+                    key_values,
+                    numeric,
+                    random_sort,
+                    reverse,
+                    chunk_size=chunk_size,
+                    jobs=jobs,
+                )
+                if buffer_size is None:
+                    # the sort of the concatenated runs is stable and merges
+                    # them (in C)
+                    merged = list(itertools.chain.from_iterable(runs))
+                    merged.sort(key=operator.itemgetter(0), reverse=reverse)
+                else:
+                    merged = _merge_spilled(list(map(_spill, runs)), reverse)
+                sorted_rows = (row for _, row in merged)
+            elif buffer_size is None:
+                sorted_rows = (
+                    row
+                    for row in sorted(
+                        self._lists_in(stage), key=key_fun, reverse=reverse
+                    )
+                )
+            else:
+                if buffer_size < 1:
+                    raise ValueError("buffer_size must be a positive number of rows")
+                sorted_rows = (
+                    row
+                    for _, row in _external_sort(
+                        ((key_fun(row), row) for row in self._lists_in(stage)),
+                        reverse=reverse,
+                        buffer_size=buffer_size,
+                    )
+                )
 
-        key_fun = lambda row: append_random(tuple(cast_numeric(row[k]) for k in keys))
+        return ContentCsv(
+            stats=self._stats,
+            _fieldnames=self.fieldnames,
+            _rows=self._rows_out(stage, sorted_rows),
+        )
 
+    def _column_formats(self, fmt):
+        positions = _positions(self.fieldnames)
+        formats = []
+        for colfmt in fmt or ():
+            if colfmt.colname not in positions:
+                raise CsvColumnsNotFound(
+                    "Column {} is not found.".format(colfmt.colname)
+                )
+            formats.append((positions[colfmt.colname], colfmt.formatter()))
+        return formats
+
+    def formatted(self, fmt=None):
+        # Values are formatted as they are written, the content can then be
+        # processed as if it was written and read again.
+        formats = self._column_formats(fmt)
+        stage = self._stage("format")
         return ContentCsv(
+            stats=self._stats,
             _fieldnames=self.fieldnames,
-            _rows=(row for row in sorted(self.rows, key=key_fun, reverse=reverse)),
+            _rows=self._rows_out(
+                stage, _formatted_rowgen(self._lists_in(stage), formats)
+            ),
         )
 
-    def write(self, f, *, delim=",", fmt=None):
+    def write(self, f, *, delim=",", fmt=None, header=True):
         dialect = csv.excel
         dialect.delimiter = delim
-        writer = csv.DictWriter(f, self.fieldnames, dialect=dialect)
-        writer.writeheader()
-        for l in self.rows:
-            row = l.copy()
-            for colfmt in fmt:
-                colfmt.format(row)
-            writer.writerow(row)
+        formats = self._column_formats(fmt)
+        writer = csv.writer(f, dialect=dialect)
+        stage = self._stage("write")
+        with self._measure(stage):
+            if header:
+                writer.writerow(self.fieldnames)
+            rows = self._lists_in(stage)
+            if formats:
+                rows = _formatted_lists(rows, formats)
+            # rows are written by batches, limiting the calls from python
+            while True:
+                batch = list(itertools.islice(rows, _WRITE_BATCH))
+                if not batch:
+                    break
+                writer.writerows(batch)
+        if stage is not None:
+            stage.rows_out = stage.rows_in